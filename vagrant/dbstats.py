@@ -0,0 +1,272 @@
+#
+# dbstats.py -- statement statistics for the psycopg2 projects in /vagrant
+#
+# tournament.py and forumdb.py open their connections with
+# InstrumentedConnection, whose cursors time every statement once
+# enableStats() is called.  The counts are kept per function: the outermost
+# public function of a registered module on the stack, so a statement issued
+# by a helper is charged to the API call that needed it.  Statements slower
+# than SLOW_QUERY_SECONDS are written to SLOW_QUERY_LOG together with their
+# EXPLAIN plan.  The query of a named (server-side) cursor is timed over its
+# DECLARE and every FETCH.  With neither turned on, cursors neither time
+# statements nor look up the function they were issued from.
+#
+# isBroken() and isDropped() tell the connection pools of both modules
+# which connections to discard.
+#
+# The scripts importing tournament.py or forumdb.py put this directory on
+# sys.path themselves.
+#
+
+import re
+import select
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+# Statements taking at least this many seconds are logged with their plan;
+# None logs nothing.
+SLOW_QUERY_SECONDS = None
+SLOW_QUERY_LOG = sys.stderr
+
+# Statements that can be explained.  Others, such as PREPARE, are logged
+# without a plan.
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with', 'values', 'execute')
+
+# The DECLARE psycopg2 wraps around the query of a named cursor
+DECLARE = re.compile(r'\s*declare\s+("[^"]*"|\S+)\s+(\w+\s+)*?cursor\s+(\w+\s+)*?for\s+',
+                     re.IGNORECASE)
+
+_modules = set()
+
+# Whether statements are counted, as turned on by enableStats()
+_enabled = False
+
+# Per function: [connects, cursors, statements, seconds, rows]
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def register(module_name):
+    """Charges statements to the functions of the named module."""
+    _modules.add(module_name)
+
+
+def enableStats():
+    """Starts counting the statements of the registered modules."""
+    global _enabled
+    _enabled = True
+
+
+def disableStats():
+    """Stops counting statements.  The counts so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def _timed():
+    """True if statements are timed, to be counted or logged when slow"""
+    return _enabled or SLOW_QUERY_SECONDS is not None
+
+
+def _caller():
+    """Name of the function to charge the current statement to"""
+    frame = sys._getframe(2)
+    outermost = public = None
+    while frame is not None:
+        module = frame.f_globals.get('__name__')
+        if module in _modules:
+            code = frame.f_code
+            outermost = (module, code.co_name)
+            function = frame.f_globals.get(code.co_name)
+            if (getattr(function, '__code__', None) is code
+                    and not code.co_name.startswith('_')):
+                public = outermost
+        frame = frame.f_back
+    name = public or outermost
+    return '%s.%s' % name if name else '(unregistered)'
+
+
+def _record(function, index, amount=1):
+    with _stats_lock:
+        stats = _stats.setdefault(function, [0, 0, 0, 0.0, 0])
+        stats[index] += amount
+
+
+def _recordStatement(function, seconds, rows, statements=1):
+    with _stats_lock:
+        stats = _stats.setdefault(function, [0, 0, 0, 0.0, 0])
+        stats[2] += statements
+        stats[3] += seconds
+        stats[4] += max(rows, 0)
+
+
+def _logSlowQuery(connection, query, function, seconds):
+    """Writes a slow statement and, if it can be explained, its plan"""
+    query = query or ''
+    lines = ["slow query: %.1f ms in %s" % (seconds * 1000, function),
+             "  " + query.strip()]
+    # A named cursor's plan is that of the query it declares
+    declare = DECLARE.match(query)
+    if declare:
+        query = query[declare.end():]
+    if query.lstrip().split(None, 1)[0].lower() in EXPLAINABLE:
+        # Explained on a plain cursor inside a savepoint, so a statement
+        # that cannot be explained does not abort the caller's transaction.
+        plain = psycopg2.extensions.cursor(connection)
+        try:
+            plain.execute("savepoint dbstats_explain")
+            try:
+                plain.execute("explain " + query)
+                lines.extend("    " + row[0] for row in plain.fetchall())
+            except psycopg2.Error as e:
+                lines.append("  (no plan: %s)" % str(e).strip())
+                plain.execute("rollback to savepoint dbstats_explain")
+            plain.execute("release savepoint dbstats_explain")
+        except psycopg2.Error:
+            pass
+        finally:
+            plain.close()
+    SLOW_QUERY_LOG.write('\n'.join(lines) + '\n')
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor recording the time and rows of each statement it executes.
+
+    A named cursor only declares its query in execute(); the rows are read
+    by its fetches, whose time and rows are added to the statement's.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedCursor, self).__init__(*args, **kwargs)
+        if _enabled:
+            _record(_caller(), 1)
+        # [query, seconds spent on it, whether it was logged as slow], or
+        # None if its statement was not timed
+        self.timing = None
+
+    def execute(self, query, vars=None):
+        if not _timed():
+            self.timing = None
+            return super(InstrumentedCursor, self).execute(query, vars)
+        start = time.time()
+        super(InstrumentedCursor, self).execute(query, vars)
+        seconds = time.time() - start
+        if _enabled:
+            _recordStatement(_caller(), seconds, self.rowcount)
+        self.timing = [self.query, seconds, False]
+        self._logIfSlow()
+
+    def _fetched(self, start, rows):
+        """Charges a fetch of a named cursor to its query"""
+        if self.name is None or self.timing is None:
+            return
+        seconds = time.time() - start
+        if _enabled:
+            _recordStatement(_caller(), seconds, rows, statements=0)
+        self.timing[1] += seconds
+        self._logIfSlow()
+
+    def _logIfSlow(self):
+        query, seconds, logged = self.timing
+        if SLOW_QUERY_SECONDS is not None and not logged and seconds >= SLOW_QUERY_SECONDS:
+            self.timing[2] = True
+            _logSlowQuery(self.connection, query, _caller(), seconds)
+
+    def fetchone(self):
+        start = time.time()
+        row = super(InstrumentedCursor, self).fetchone()
+        self._fetched(start, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        if size is None:
+            size = self.arraysize
+        rows = super(InstrumentedCursor, self).fetchmany(size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.time()
+        rows = super(InstrumentedCursor, self).fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __iter__(self):
+        if self.name is None:
+            return super(InstrumentedCursor, self).__iter__()
+        return self._iterNamed()
+
+    def _iterNamed(self):
+        # Reads itersize rows per FETCH, as iterating a named cursor does
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """A connection whose cursors are InstrumentedCursors"""
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedConnection, self).__init__(*args, **kwargs)
+        if _enabled:
+            _record(_caller(), 0)
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', InstrumentedCursor)
+        return super(InstrumentedConnection, self).cursor(*args, **kwargs)
+
+
+def isBroken(db):
+    """True if a connection can no longer be used and must be discarded"""
+    if db.closed:
+        return True
+    status = db.get_transaction_status()
+    return status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+
+def isDropped(db):
+    """True if the server dropped an idle connection that is not broken.
+
+    A terminated backend leaves the connection's socket readable, which
+    costs no round trip to notice.
+    """
+    return bool(select.select([db], [], [], 0)[0])
+
+
+def stats():
+    """Returns the counts recorded since the last reset.
+
+    Returns:
+      A dict mapping each function name to a dict with its 'connects',
+      'cursors', 'statements', 'seconds' spent executing them and 'rows'
+      returned or changed.
+    """
+    with _stats_lock:
+        return dict((function, dict(zip(('connects', 'cursors', 'statements',
+                                         'seconds', 'rows'), counts)))
+                    for (function, counts) in _stats.items())
+
+
+def resetStats():
+    """Clears the counts returned by stats()."""
+    with _stats_lock:
+        _stats.clear()
+
+
+def dumpStats(out=sys.stdout):
+    """Writes stats() as a table, most time spent first."""
+    rows = sorted(stats().items(), key=lambda item: -item[1]['seconds'])
+    out.write("%-44s %8s %8s %10s %10s %10s\n" % (
+        'function', 'connects', 'cursors', 'statements', 'ms', 'rows'))
+    for function, counts in rows:
+        out.write("%-44s %8d %8d %10d %10.1f %10d\n" % (
+            function, counts['connects'], counts['cursors'], counts['statements'],
+            counts['seconds'] * 1000, counts['rows']))
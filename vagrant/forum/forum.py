@@ -2,28 +2,43 @@
 # DB Forum - a buggy web forum server backed by a good database
 #
 
+import os
+import sys
+
+# The dbstats module counts the statements forumdb runs.  It is shared with
+# the tournament, one directory up.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import dbstats
 # The forumdb module is where the database interface code goes.
 import forumdb
+# The forumcache module keeps rendered pages until a post is added.
+import forumcache
 
 # Other modules used to run a web server.
+import argparse
 import cgi
-from wsgiref.simple_server import make_server
+import Queue
+import threading
+import urllib
+import zlib
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 from wsgiref import util
 
-# HTML template for the forum page
-HTML_WRAP = '''\
+# HTML templates for the forum page, sent before and after the posts
+HTML_HEAD = '''\
 <!DOCTYPE html>
 <html>
   <head>
     <title>DB Forum</title>
     <style>
-      h1, form { text-align: center; }
+      h1, h2, form { text-align: center; }
       textarea { width: 400px; height: 100px; }
       div.post { border: 1px solid #999;
                  padding: 10px 10px;
-		 margin: 10px 20%%; }
-      hr.postbound { width: 50%%; }
+		 margin: 10px 20%; }
+      hr.postbound { width: 50%; }
       em.date { color: #999 }
+      div.older { text-align: center; }
     </style>
   </head>
   <body>
@@ -32,29 +47,189 @@ HTML_WRAP = '''\
       <div><textarea id="content" name="content"></textarea></div>
       <div><button id="go" type="submit">Post message</button></div>
     </form>
+    <form method=get action="/search">
+      <div><input name="q"> <button type="submit">Search</button></div>
+    </form>
     <!-- post content will go here -->
-%s
+'''
+HTML_FOOT = '''\
   </body>
 </html>
 '''
 
-# HTML template for an individual comment
+# HTML template for an individual comment, filled in with (time, content)
 POST = '''\
-    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+    <div class=post><em class=date>%s</em><br>%s</div>
+'''
+
+# Posts never change once added, so their rendered HTML is kept by id.
+# Lookups need no lock: single dict operations are atomic, and two threads
+# rendering the same post store the same fragment.
+POST_FRAGMENT_CACHE_SIZE = 4096
+post_fragments = {}
+
+# HTML template for the link to the next page of older posts
+OLDER = '''\
+    <div class=older><a href="/?before=%d">Older posts</a></div>
+'''
+
+# HTML templates for the heading and the next page link of search results
+SEARCH_HEADING = '''\
+    <h2>Posts matching "%s"</h2>
+'''
+MORE_RESULTS = '''\
+    <div class=older><a href="/search?q=%s&amp;page=%d">More results</a></div>
 '''
 
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and one page of the previously posted
+    messages.  The ?before= query parameter selects the page of posts older
+    than the post with that id.
+    '''
+    query = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    try:
+        before = int(query['before'][0])
+    except (KeyError, ValueError):
+        before = None
+    gzipped = AcceptsGzip(env.get('HTTP_ACCEPT_ENCODING', ''))
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    # Cached pages are stored with their ETag on the first line, and are
+    # dropped when a post is added, so a hit answers without the database.
+    key = ('gzip:' if gzipped else '') + str(before)
+    cached, generation = forumcache.GetPage(key)
+    if cached is not None:
+        etag, page = cached.split('\n', 1)
+        if if_none_match is not None and NoneMatch(if_none_match, etag):
+            resp('304 Not Modified', PageHeaders(etag, False)[1:])
+            return []
+        resp('200 OK', PageHeaders(etag, gzipped))
+        return [page]
+    # Pages only change when a post is added, so the newest post's id
+    # tells whether the client's copy is still current.
+    etag = ETag(forumdb.LatestPostId())
+    if if_none_match is not None and NoneMatch(if_none_match, etag):
+        resp('304 Not Modified', PageHeaders(etag, False)[1:])
+        return []
+    resp('200 OK', PageHeaders(etag, gzipped))
+    # send results as the posts are read from the database
+    chunks = Page(before)
+    if gzipped:
+        chunks = Gzipped(chunks)
+    return forumcache.StoringPage(chunks, key, generation, etag + '\n')
+
+def ETag(latest_post_id):
+    '''ETag of every page while latest_post_id is the newest post.
+
+    Weak, because the same page is sent both plain and gzipped.
+    '''
+    return 'W/"%d"' % latest_post_id
+
+def AcceptsGzip(accept_encoding):
+    '''True if an Accept-Encoding header lets the page be sent gzipped.
+
+    gzip, or failing that *, must be listed with a q-value above 0.
+    '''
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[params[0].strip().lower()] = q
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+def NoneMatch(if_none_match, etag):
+    '''True if an If-None-Match header matches etag.'''
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or etag[2:] in tags
+
+def PageHeaders(etag, gzipped):
+    '''Headers of a forum page; clients revalidate it on every view.'''
+    headers = [('Content-type', 'text/html'),
+               ('ETag', etag),
+               ('Cache-Control', 'no-cache'),
+               ('Vary', 'Accept-Encoding')]
+    if gzipped:
+        headers.append(('Content-Encoding', 'gzip'))
+    return headers
+
+def Gzipped(chunks):
+    '''Compress chunks into a gzip stream as they are produced.
+
+    The compressor is flushed after the first chunk so the page header
+    still reaches the client before the posts are read.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
-    # send results
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    try:
+        for count, chunk in enumerate(chunks):
+            data = compressor.compress(chunk)
+            if count == 0:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+    finally:
+        chunks.close()
+    yield compressor.flush()
+
+def Page(before):
+    '''Render one page of posts piece by piece, newest first.
+
+    Yields the page header, each post as it is read from the database, an
+    'Older posts' link if there are more, and the page footer.
+    '''
+    yield HTML_HEAD
+    # Ask for one post more than a page to know whether older posts exist
+    rows = forumdb.IterPostRows(before, forumdb.PAGE_SIZE + 1)
+    try:
+        last = None
+        for count, row in enumerate(rows):
+            if count == forumdb.PAGE_SIZE:
+                yield OLDER % last[2]
+                break
+            yield RenderPost(row)
+            last = row
+    finally:
+        rows.close()
+    yield HTML_FOOT
+
+def RenderPost(row):
+    '''Return the HTML of a (time, content, id) row of the posts table.'''
+    fragment = post_fragments.get(row[2])
+    if fragment is None:
+        if len(post_fragments) >= POST_FRAGMENT_CACHE_SIZE:
+            post_fragments.clear()
+        fragment = post_fragments[row[2]] = POST % row[:2]
+    return fragment
+
+## Request handler for searching posts
+def Search(env, resp):
+    '''Search shows the posts matching ?q=, best matches first.
+
+    Results are shown a page at a time; ?page= selects the page.
+    '''
+    query = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    terms = query.get('q', [''])[0].strip()
+    try:
+        page = max(int(query['page'][0]), 0)
+    except (KeyError, ValueError):
+        page = 0
+    posts, more = forumdb.SearchPosts(terms, page) if terms else ([], False)
+    html = [HTML_HEAD, SEARCH_HEADING % cgi.escape(terms, quote=True)]
+    html.extend(POST % (p['time'], p['content']) for p in posts)
+    if more:
+        html.append(MORE_RESULTS % (urllib.quote_plus(terms), page + 1))
+    html.append(HTML_FOOT)
     headers = [('Content-type', 'text/html')]
     resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    return html
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
@@ -85,6 +260,7 @@ def Post(env, resp):
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -100,7 +276,116 @@ def Dispatcher(env, resp):
         return ['Not Found: ' + page]
 
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
+## WSGI server handling requests concurrently on a pool of threads
+
+# Listen backlog of the server socket.  TCPServer's default of 5 overflows
+# on bursts of connections, which the clients then retry after a second.
+MIN_LISTEN_BACKLOG = 128
+LISTEN_BACKLOG_PER_THREAD = 16
+
+class PooledWSGIServer(WSGIServer):
+    '''WSGIServer that hands each request to one of `threads` workers.
+
+    Accepted requests wait in a queue while every worker is busy, so one
+    slow request no longer holds up the others.  Connections not yet
+    accepted wait in a listen backlog of `backlog`, by default
+    LISTEN_BACKLOG_PER_THREAD per worker.
+    '''
+
+    def __init__(self, address, handler, threads, backlog=None):
+        # Read by server_activate() when WSGIServer.__init__ listens
+        self.request_queue_size = backlog or max(
+            MIN_LISTEN_BACKLOG, threads * LISTEN_BACKLOG_PER_THREAD)
+        WSGIServer.__init__(self, address, handler)
+        self.threads = threads
+        self.requests = Queue.Queue()
+
+    def serve_forever(self, *args, **kwargs):
+        # Workers are started here rather than in __init__ so that they
+        # exist in every process when the server is forked.
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+        WSGIServer.serve_forever(self, *args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+def Serve(port=8000, threads=8, processes=1, backlog=None):
+    '''Serve the forum with `threads` workers in each of `processes` processes.
+
+    The processes share the listening socket.  Each has its own connection
+    pool.  A forumcache.LRUCache would only be invalidated in the process
+    that added a post, so with more than one process the page cache is
+    turned off unless it is shared, as forumcache.RedisCache is.
+    '''
+    if processes > 1 and isinstance(forumcache.backend, forumcache.LRUCache):
+        forumcache.SetBackend(None)
+    httpd = PooledWSGIServer(('', port), WSGIRequestHandler, threads, backlog)
+    httpd.set_app(Dispatcher)
+    for _ in range(processes - 1):
+        if os.fork() == 0:
+            break
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the DB Forum.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='worker threads per process')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='server processes sharing the port')
+    parser.add_argument('--backlog', type=int,
+                        help='listen backlog (default: %d per thread, at least %d)'
+                        % (LISTEN_BACKLOG_PER_THREAD, MIN_LISTEN_BACKLOG))
+    parser.add_argument('--redis', metavar='HOST[:PORT]',
+                        help='share the page cache between processes through Redis')
+    parser.add_argument('--pool-size', type=int, default=forumdb.POOL_MAX_SIZE,
+                        help='database connections per process (default: %(default)s)')
+    parser.add_argument('--pool-idle-timeout', type=float,
+                        default=forumdb.POOL_IDLE_TIMEOUT,
+                        help='seconds an idle connection is kept (default: %(default)s)')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='commit posts arriving together in batches')
+    parser.add_argument('--slow-query-ms', type=float,
+                        help='log statements slower than this with their plan')
+    parser.add_argument('--stats', action='store_true',
+                        help='count the statements of each call and print them on exit')
+    args = parser.parse_args()
+    if args.pool_size < 1:
+        parser.error('--pool-size must be at least 1')
+    forumdb.POOL_MAX_SIZE = args.pool_size
+    forumdb.POOL_MIN_SIZE = min(forumdb.POOL_MIN_SIZE, args.pool_size)
+    forumdb.POOL_IDLE_TIMEOUT = args.pool_idle_timeout
+    if args.write_behind:
+        forumdb.EnableWriteBehind()
+    if args.redis:
+        host, _, port = args.redis.partition(':')
+        forumcache.SetBackend(forumcache.RedisCache(host, int(port or 6379)))
+    elif args.processes > 1:
+        print "Page cache off: pass --redis to share it between processes."
+    if args.slow_query_ms is not None:
+        dbstats.SLOW_QUERY_SECONDS = args.slow_query_ms / 1000.0
+    if args.stats:
+        dbstats.enableStats()
+    # Run this bad server only on localhost!
+    print "Serving HTTP on port %d with %d threads in %d processes..." % (
+        args.port, args.threads, args.processes)
+    try:
+        Serve(args.port, args.threads, args.processes, args.backlog)
+    except KeyboardInterrupt:
+        # Each process prints the statements it ran
+        if args.stats:
+            dbstats.dumpStats()
@@ -1,5 +1,17 @@
 
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL,
+                     search TSVECTOR );
 
+-- The front page reads posts newest first, a page at a time, by keyset
+-- on (time, id).
+CREATE UNIQUE INDEX posts_id_idx ON posts (id);
+CREATE INDEX posts_time_id_idx ON posts (time, id);
+
+-- Full-text search: posts.search holds the words of the content and is
+-- filled in on every insert or update.
+CREATE TRIGGER posts_search_update BEFORE INSERT OR UPDATE ON posts
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search, 'pg_catalog.english', content);
+CREATE INDEX posts_search_idx ON posts USING gin (search);
@@ -0,0 +1,120 @@
+#
+# Benchmarks for the web forum, calling the WSGI app in-process.
+# Reads the posts already in the "forum" database.
+#
+#   python forum_bench.py [name ...]
+#
+
+import os
+import random
+import StringIO
+import sys
+import time
+
+import bleach
+
+# dbstats.py, which forumdb.py uses, is shared with the tournament one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dbstats
+import forum
+import forumcache
+import forumdb
+
+def Request(path='/', query=''):
+    '''Run one GET request through the forum's Dispatcher.'''
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '',
+           'QUERY_STRING': query, 'wsgi.input': StringIO.StringIO()}
+    status = []
+    body = ''.join(forum.Dispatcher(env, lambda s, h: status.append(s)))
+    return status[0], body
+
+def RequestsPerSecond(requests, query=''):
+    start = time.time()
+    for _ in xrange(requests):
+        Request('/', query)
+    return requests / (time.time() - start)
+
+def BenchCache(requests=2000):
+    '''Compare front page requests per second with each cache backend.'''
+    print "cache: %d front page requests" % requests
+    backends = [('no cache', None), ('LRU', forumcache.LRUCache())]
+    try:
+        backends.append(('Redis', forumcache.RedisCache()))
+    except ImportError:
+        print "  (redis module not installed, skipping Redis)"
+    for name, backend in backends:
+        forumcache.SetBackend(backend)
+        if backend is not None:
+            backend.invalidate()
+        forumcache.ResetStats()
+        rate = RequestsPerSecond(requests)
+        stats = forumcache.Stats()
+        print "  %-9s %10.1f requests/s (%d hits, %d misses)" % (
+            name, rate, stats['hits'], stats['misses'])
+
+def PostCorpus(posts=20000):
+    '''Posts as a busy forum sees them: mostly plain text, some with
+    markup, and a flood of identical spam bodies.'''
+    random.seed(0)
+    words = ("the quick brown fox jumps over a lazy dog while "
+             "everyone on the forum argues about databases").split()
+    spam = ['<a href="http://spam.example/%d">CHEAP PILLS</a> & more!!!' % i
+            for i in range(5)]
+    corpus = []
+    for i in xrange(posts):
+        text = ' '.join(random.choice(words) for _ in xrange(random.randint(5, 200)))
+        kind = random.random()
+        if kind < 0.3:
+            corpus.append(random.choice(spam))
+        elif kind < 0.5:
+            corpus.append('<b>%s</b> <script>alert(%d)</script>\r\n%s' % (text, i, text))
+        else:
+            corpus.append(text)
+    return corpus
+
+def BenchSanitize(posts=20000):
+    '''Compare forumdb.Sanitize with calling bleach.clean for every post.'''
+    corpus = PostCorpus(posts)
+    start = time.time()
+    expected = [bleach.clean(content) for content in corpus]
+    before = time.time() - start
+    start = time.time()
+    actual = [forumdb.Sanitize(content) for content in corpus]
+    after = time.time() - start
+    if actual != expected:
+        raise ValueError("Sanitize should give the same result as bleach.clean")
+    print "sanitize: %d posts" % posts
+    print "  bleach.clean per post: %10.1f posts/s" % (posts / before)
+    print "  forumdb.Sanitize:      %10.1f posts/s" % (posts / after)
+
+def BenchRender(pages=2000):
+    '''Compare rendering a page of posts from dictionaries with rendering
+    it from the post rows through forum.RenderPost.'''
+    rows = list(forumdb.IterPostRows(None, forumdb.PAGE_SIZE))
+    start = time.time()
+    for _ in xrange(pages):
+        posts = [{'content': str(row[1]), 'time': str(row[0]), 'id': row[2]}
+                 for row in rows]
+        ''.join('<div class=post><em class=date>%(time)s</em><br>%(content)s</div>\n' % p
+                for p in posts)
+    before = time.time() - start
+    start = time.time()
+    for _ in xrange(pages):
+        ''.join(forum.RenderPost(row) for row in rows)
+    after = time.time() - start
+    print "render: %d pages of %d posts" % (pages, len(rows))
+    print "  dictionary per post:  %10.1f pages/s" % (pages / before)
+    print "  forum.RenderPost:     %10.1f pages/s" % (pages / after)
+
+BENCHMARKS = {'cache': BenchCache,
+              'render': BenchRender,
+              'sanitize': BenchSanitize,
+              }
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    dbstats.enableStats()
+    for name in names:
+        BENCHMARKS[name]()
+    dbstats.dumpStats()
@@ -0,0 +1,59 @@
+#
+# Load test for a running forum server.
+# Reports throughput and p50/p99 latency of front page requests at several
+# concurrency levels.
+#
+#   python forum_loadtest.py [--url URL] [--requests N] [concurrency ...]
+#
+
+import argparse
+import threading
+import time
+import urllib2
+
+def Percentile(latencies, fraction):
+    '''Return the latency below which `fraction` of latencies fall.'''
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def Client(url, requests, latencies, errors):
+    '''Fetch url `requests` times in a row, recording each latency.'''
+    for _ in xrange(requests):
+        start = time.time()
+        try:
+            urllib2.urlopen(url).read()
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.time() - start)
+
+def Run(url, concurrency, requests):
+    '''Spread `requests` over `concurrency` clients and report the latencies.'''
+    latencies = []
+    errors = []
+    clients = [threading.Thread(target=Client,
+                                args=(url, requests // concurrency, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    if not latencies:
+        print "%4d clients: every request failed" % concurrency
+        return
+    print "%4d clients: %8.1f requests/s  p50 %8.2f ms  p99 %8.2f ms  %d errors" % (
+        concurrency, len(latencies) / elapsed,
+        Percentile(latencies, 0.50) * 1000, Percentile(latencies, 0.99) * 1000,
+        len(errors))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the DB Forum.')
+    parser.add_argument('--url', default='http://localhost:8000/')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per concurrency level')
+    parser.add_argument('concurrency', type=int, nargs='*', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+    for concurrency in args.concurrency:
+        Run(args.url, concurrency, args.requests)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Test cases for forum.py
+# The View tests read the forum database but add no posts to it.
+#
+
+import os
+import sys
+import time
+import zlib
+
+# dbstats.py, which forumdb.py uses, is shared with the tournament one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import forum
+import forumcache
+import forumdb
+
+
+class Response(object):
+    """Records the status and headers a WSGI handler starts its response with"""
+
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+
+def view(**env):
+    """Runs forum.View on a request with the given environ entries"""
+    resp = Response()
+    body = ''.join(forum.View(env, resp))
+    return resp, body
+
+
+def testAcceptsGzip():
+    """Test that Accept-Encoding headers are parsed with their q-values"""
+    accepted = ['gzip', 'deflate, gzip', 'GZip', 'gzip;q=0.5', 'br, *', 'gzip; q=1.0, *;q=0']
+    refused = ['', 'identity', 'deflate, br', 'gzip;q=0', 'gzip;q=0.0, *', '*;q=0', 'gzip;q=x']
+    for header in accepted:
+        if not forum.AcceptsGzip(header):
+            raise ValueError("Accept-Encoding {h!r} should allow gzip".format(h=header))
+    for header in refused:
+        if forum.AcceptsGzip(header):
+            raise ValueError("Accept-Encoding {h!r} should not allow gzip".format(h=header))
+    print "1. AcceptsGzip() honours q-values and the * coding."
+
+
+def testNoneMatch():
+    """Test that If-None-Match headers match weak and strong ETags"""
+    etag = forum.ETag(42)
+    if etag != 'W/"42"':
+        raise ValueError("ETag(42) should be W/\"42\". Got {e}".format(e=etag))
+    for header in ['W/"42"', '"42"', '"41", W/"42"', ' W/"42" ', '*']:
+        if not forum.NoneMatch(header, etag):
+            raise ValueError("If-None-Match {h!r} should match {e}".format(h=header, e=etag))
+    for header in ['W/"41"', '"4"', '42', 'W/"420"']:
+        if forum.NoneMatch(header, etag):
+            raise ValueError("If-None-Match {h!r} should not match {e}".format(h=header, e=etag))
+    print "2. NoneMatch() compares ETags weakly and accepts *."
+
+
+def testViewRevalidation():
+    """Test that a cached page is revalidated without reading the database"""
+    calls = []
+    latest_post_id = forumdb.LatestPostId
+
+    def countingLatestPostId():
+        calls.append(1)
+        return latest_post_id()
+
+    forumcache.SetBackend(forumcache.LRUCache())
+    forumdb.LatestPostId = countingLatestPostId
+    try:
+        resp, page = view()
+        if resp.status != '200 OK' or not page.startswith('<!DOCTYPE html>'):
+            raise ValueError("The first view should render the page")
+        etag = resp.headers['ETag']
+        if len(calls) != 1:
+            raise ValueError("Rendering a page should look up its ETag once")
+        print "3. A page is rendered with its ETag."
+
+        resp, body = view(HTTP_IF_NONE_MATCH=etag)
+        if resp.status != '304 Not Modified' or body:
+            raise ValueError("A current ETag should be answered with 304 Not Modified")
+        if resp.headers.get('ETag') != etag:
+            raise ValueError("A 304 should repeat the ETag")
+        resp, body = view(HTTP_IF_NONE_MATCH='W/"-1"')
+        if resp.status != '200 OK' or body != page:
+            raise ValueError("A stale ETag should get the cached page")
+        if len(calls) != 1:
+            raise ValueError(
+                "Cached pages should be revalidated without the database. Got {n} lookups".format(n=len(calls)))
+        print "4. A cached page is revalidated without reading the database."
+
+        resp, body = view(HTTP_ACCEPT_ENCODING='gzip')
+        if resp.headers.get('Content-Encoding') != 'gzip':
+            raise ValueError("A client accepting gzip should get the page gzipped")
+        if zlib.decompress(body, zlib.MAX_WBITS | 16) != page:
+            raise ValueError("The gzipped page should be the same page")
+        resp, body = view(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        if resp.status != '304 Not Modified' or 'Content-Encoding' in resp.headers:
+            raise ValueError("A 304 should be sent without a body or its encoding")
+        print "5. The gzipped page is cached and revalidated apart from the plain one."
+
+        forumcache.Invalidate()
+        resp, body = view(HTTP_IF_NONE_MATCH=etag)
+        if resp.status != '304 Not Modified':
+            raise ValueError("Without a cached page, a current ETag should still get 304")
+        if len(calls) != 3:
+            raise ValueError("Without a cached page, the ETag should be looked up again")
+        print "6. Without a cached page, the ETag is checked against the database."
+    finally:
+        forumdb.LatestPostId = latest_post_id
+        forumcache.SetBackend(forumcache.LRUCache())
+
+
+def testDroppedConnections():
+    """Test that a pooled connection the server dropped is not handed out"""
+    pool = forumdb.GetPool()
+    pool.putconn(pool.getconn())
+    db = forumdb.getConnection()
+    c = db.cursor()
+    c.execute("""select pg_terminate_backend(pid) from pg_stat_activity
+                 where datname = current_database() and pid <> pg_backend_pid()""")
+    db.close()
+    time.sleep(0.1)
+    db = pool.getconn()
+    try:
+        c = db.cursor()
+        c.execute("select 1")
+        c.close()
+    finally:
+        pool.putconn(db)
+    print "7. Pooled connections the server dropped are replaced on checkout."
+
+
+if __name__ == '__main__':
+    testAcceptsGzip()
+    testNoneMatch()
+    testViewRevalidation()
+    testDroppedConnections()
+    print "Success!  All tests pass!"
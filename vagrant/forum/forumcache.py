@@ -0,0 +1,137 @@
+#
+# Rendered page cache for the web forum.
+#
+# Pages are cached under the current generation; AddPost starts a new
+# generation, so every cached page is invalidated at once.  A page rendered
+# while a post was being added is stored under the generation it started
+# in, and is never served.
+#
+
+import collections
+import threading
+
+## Cache backends
+class LRUCache(object):
+    '''In-process cache keeping the most recently used pages.
+
+    Only invalidated by posts added in the same process.
+    '''
+
+    def __init__(self, max_pages=128):
+        self.max_pages = max_pages
+        self.generation = 0
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        '''Returns (page or None, generation to store a fresh page under).'''
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page is not None:
+                self.pages[key] = page
+            return page, self.generation
+
+    def store(self, key, generation, page):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.pages[key] = page
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.pages.clear()
+
+
+class RedisCache(object):
+    '''Cache shared by every server process through Redis.
+
+    Pages expire after ttl seconds, so pages of old generations do not
+    accumulate.
+    '''
+
+    def __init__(self, host='localhost', port=6379, ttl=300, prefix='forum'):
+        import redis
+        self.redis = redis.StrictRedis(host=host, port=port)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def pageKey(self, generation, key):
+        return '%s:page:%s:%s' % (self.prefix, generation, key)
+
+    def lookup(self, key):
+        '''Returns (page or None, generation to store a fresh page under).'''
+        generation = int(self.redis.get(self.prefix + ':generation') or 0)
+        return self.redis.get(self.pageKey(generation, key)), generation
+
+    def store(self, key, generation, page):
+        self.redis.setex(self.pageKey(generation, key), self.ttl, page)
+
+    def invalidate(self):
+        self.redis.incr(self.prefix + ':generation')
+
+
+## Configured backend, or None to disable caching
+backend = LRUCache()
+
+_counts = {'hits': 0, 'misses': 0}
+_counts_lock = threading.Lock()
+
+def SetBackend(new_backend):
+    '''Switch to another backend (LRUCache, RedisCache or None).'''
+    global backend
+    backend = new_backend
+
+def _count(name):
+    with _counts_lock:
+        _counts[name] += 1
+
+def Stats():
+    '''Returns a dictionary with the number of cache 'hits' and 'misses'.'''
+    with _counts_lock:
+        return dict(_counts)
+
+def ResetStats():
+    with _counts_lock:
+        _counts['hits'] = _counts['misses'] = 0
+
+## Page lookups
+def GetPage(key):
+    '''Look up a cached page.
+
+    Args:
+      key: identifies the page and its variant, e.g. its ?before= cursor
+        and whether it is compressed.
+    Returns:
+      A (page, generation) tuple.  page is the cached page, or None on a
+      miss; a page rendered now should be stored by StoringPage() under
+      generation.
+    '''
+    if backend is None:
+        return None, None
+    page, generation = backend.lookup(key)
+    _count('hits' if page is not None else 'misses')
+    return page, generation
+
+def StoringPage(chunks, key, generation, header=''):
+    '''Pass rendered chunks through, storing the page once it is complete.
+
+    The page is stored as header followed by the chunks.  A page whose
+    rendering was abandoned part way is not stored.
+    '''
+    rendered = [header]
+    try:
+        for chunk in chunks:
+            rendered.append(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+    if backend is not None and generation is not None:
+        backend.store(key, generation, ''.join(rendered))
+
+def Invalidate():
+    '''Drop every cached page.  Called whenever a post is added.'''
+    if backend is not None:
+        backend.invalidate()
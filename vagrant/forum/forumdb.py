@@ -2,13 +2,170 @@
 # Database access functions for the web forum.
 #
 
+import collections
+import contextlib
+import hashlib
+import Queue
+import re
+import threading
 import time
 import psycopg2
+import psycopg2.extensions
 import bleach
+import forumcache
+
+# dbstats.py is shared with the tournament, one directory up; the scripts using
+# this module put that directory on sys.path.
+import dbstats
+
+dbstats.register(__name__)
+
+DSN = "dbname=forum"
+
+# Connection pool settings: connections kept open even when idle, the most
+# open at once (callers beyond that wait), and how many seconds an idle
+# connection above the minimum is kept before being closed.  Read when the
+# pool is created, so they can be changed before the first query.
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+
+# Errors after which a request is retried once on a fresh connection
+RECONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
 ## Database connection
 def getConnection():
-    return psycopg2.connect("dbname=forum")
+    return psycopg2.connect(DSN, connection_factory=dbstats.InstrumentedConnection)
+
+class ConnectionPool(object):
+    '''Thread-safe pool of database connections.
+
+    Opens connections on demand and hands out at most max_size at once;
+    callers beyond that wait.  Connections idle for longer than idle_timeout
+    seconds are closed, keeping min_size open, and connections the server
+    dropped are replaced with new ones.
+    '''
+
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # (connection, time it was returned), least recently used first
+        self.idle = []
+        # Connections open, whether idle or checked out
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def getconn(self):
+        '''Check out a connection, waiting if max_size are in use.'''
+        with self.cond:
+            while True:
+                self._closeExpired()
+                while self.idle:
+                    db, returned = self.idle.pop()
+                    if not dbstats.isBroken(db) and not dbstats.isDropped(db):
+                        return db
+                    self._discard(db)
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                self.cond.wait()
+        try:
+            return psycopg2.connect(self.dsn,
+                                    connection_factory=dbstats.InstrumentedConnection)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def putconn(self, db, broken=False):
+        '''Return a connection, rolling back any transaction left open.'''
+        if not broken and not dbstats.isBroken(db):
+            if db.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    db.rollback()
+                except psycopg2.Error:
+                    broken = True
+        with self.cond:
+            if broken or dbstats.isBroken(db):
+                self._discard(db)
+            else:
+                self.idle.append((db, time.time()))
+            self.cond.notify()
+
+    def closeall(self):
+        with self.cond:
+            while self.idle:
+                self._discard(self.idle.pop()[0])
+
+    def _discard(self, db):
+        self.size -= 1
+        if not db.closed:
+            db.close()
+
+    def _closeExpired(self):
+        cutoff = time.time() - self.idle_timeout
+        while self.idle and self.size > self.min_size and self.idle[0][1] < cutoff:
+            self._discard(self.idle.pop(0)[0])
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def GetPool():
+    '''Return the module's connection pool, creating it on first use.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DSN, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT)
+        return _pool
+
+@contextlib.contextmanager
+def Connection():
+    '''Check a connection out of the pool for the duration of a with block.
+
+    A transaction left open is rolled back when the block ends, and a
+    connection that failed is closed instead of going back to the pool.
+    '''
+    pool = GetPool()
+    db = pool.getconn()
+    broken = False
+    try:
+        yield db
+    except RECONNECT_ERRORS:
+        broken = True
+        raise
+    finally:
+        pool.putconn(db, broken)
+
+def _ReadRows(query, params=(), cursor_name=None):
+    '''Iterate over the rows of a read-only query.
+
+    With a cursor_name, rows come from a server-side cursor STREAM_BATCH at
+    a time.  If the connection fails before any row is read, the query is
+    retried once on a fresh connection; rows already yielded cannot be
+    taken back, so a later failure is raised.  Callers that stop early must
+    close the generator to return the connection.
+    '''
+    for attempt in (1, 2):
+        read = False
+        try:
+            with Connection() as db:
+                if cursor_name is None:
+                    cur = db.cursor()
+                else:
+                    cur = db.cursor(cursor_name)
+                    cur.itersize = STREAM_BATCH
+                cur.execute(query, params)
+                for row in cur:
+                    read = True
+                    yield row
+            return
+        except RECONNECT_ERRORS:
+            if read or attempt == 2:
+                raise
 
 ## Get posts from database.
 def GetAllPosts():
@@ -18,25 +175,254 @@ def GetAllPosts():
       pointing to the post content, and 'time' key pointing to the time
       it was posted.
     '''
-    db = getConnection()
-    cur = db.cursor()
-    query = "select time,content from posts order by time desc"
-    cur.execute(query)
-    posts = [{'content': str(row[1]), 'time': str(row[0])} for row in cur.fetchall()]
-    db.close()
-    # posts.sort(key=lambda row: row['time'], reverse=True)
-    return posts
+    return list(IterPosts(limit=None))
+
+# Number of posts shown per page of the forum
+PAGE_SIZE = 20
+
+# Number of rows fetched per round trip when streaming posts
+STREAM_BATCH = 50
+
+## Stream posts from the database.
+def IterPostRows(before=None, limit=PAGE_SIZE):
+    '''Iterate over posts, sorted with the newest first, as they are read.
+
+    Rows come from a server-side cursor STREAM_BATCH at a time, so callers
+    can render the first posts before the last ones are read and memory
+    does not grow with the number of posts.  Pages are found by keyset on
+    (time, id) through the posts_time_id_idx index.  The connection is
+    returned to the pool when the iteration ends or the generator is closed.
+    If the connection fails before any post is read, the query is retried
+    once on a fresh connection, as for every read through _ReadRows().
+
+    Args:
+      before: only posts older than the post with this id, or None for
+        the newest posts.
+      limit: the maximum number of posts, or None for all of them.
+    Yields:
+      (time, content, id) rows as the database returns them.
+    '''
+    query = "select time,content,id from posts"
+    params = []
+    if before is not None:
+        query += " where (time, id) < (select time, id from posts where id = %s)"
+        params.append(before)
+    query += " order by time desc, id desc"
+    if limit is not None:
+        query += " limit %s"
+        params.append(limit)
+    rows = _ReadRows(query, params, 'posts')
+    try:
+        for row in rows:
+            yield row
+    finally:
+        rows.close()
+
+def IterPosts(before=None, limit=PAGE_SIZE):
+    '''Like IterPostRows(), but yields dictionaries with 'id', 'content'
+    and 'time' keys.'''
+    rows = IterPostRows(before, limit)
+    try:
+        for row in rows:
+            yield {'content': str(row[1]), 'time': str(row[0]), 'id': row[2]}
+    finally:
+        rows.close()
+
+## Get the id of the newest post.
+def LatestPostId():
+    '''Return the id of the newest post, or 0 if there are no posts.
+
+    A single lookup at the end of the posts_id_idx index.
+    '''
+    return list(_ReadRows("select coalesce(max(id), 0) from posts"))[0][0]
+
+## Get one page of posts from the database.
+def GetPosts(before=None, limit=PAGE_SIZE):
+    '''Get a page of posts, sorted with the newest first.
+
+    Args:
+      before: the id of the last post of the previous page, or None for
+        the newest posts.
+      limit: the maximum number of posts to return.
+    Returns:
+      A (posts, older) tuple.  posts is a list of dictionaries with 'id',
+      'content' and 'time' keys; older is the before value for the next
+      page, or None if there are no older posts.
+    '''
+    posts = list(IterPosts(before, limit + 1))
+    older = posts[limit - 1]['id'] if len(posts) > limit else None
+    return posts[:limit], older
+
+## Search posts.
+def SearchPosts(terms, page=0, limit=PAGE_SIZE):
+    '''Get a page of the posts matching a full-text search, best first.
+
+    Matches are found through the GIN index on posts.search, so only the
+    matching posts are read and ranked.
+
+    Args:
+      terms: the words to search for.
+      page: the number of the page of results, starting from 0.
+      limit: the number of posts per page.
+    Returns:
+      A (posts, more) tuple.  posts is a list of dictionaries with 'id',
+      'content' and 'time' keys; more is True if there is another page.
+    '''
+    query = """select time,content,id
+               from posts, plainto_tsquery('english', %s) as terms
+               where search @@ terms
+               order by ts_rank(search, terms) desc, id desc
+               limit %s offset %s"""
+    rows = list(_ReadRows(query, (terms, limit + 1, page * limit)))
+    posts = [{'content': str(row[1]), 'time': str(row[0]), 'id': row[2]}
+             for row in rows[:limit]]
+    return posts, len(rows) > limit
+
+## Insert posts into the database.
+def InsertPosts(contents):
+    '''Insert already sanitized posts with one statement and one commit.
+
+    Args:
+      contents: The text contents of the new posts.
+    '''
+    for attempt in (1, 2):
+        committing = False
+        try:
+            with Connection() as db:
+                cur = db.cursor()
+                values = ','.join(cur.mogrify("(%s)", (content,)) for content in contents)
+                cur.execute("insert into posts (content) values " + values)
+                # If the commit itself fails the posts may have been saved,
+                # so they are not retried.
+                committing = True
+                db.commit()
+            break
+        except RECONNECT_ERRORS:
+            if committing or attempt == 2:
+                raise
+    forumcache.Invalidate()
+
+# Write-behind defaults: the most posts inserted by one transaction, and
+# the longest a post waits for its batch to fill, in seconds.
+BATCH_MAX_POSTS = 100
+BATCH_MAX_DELAY = 0.01
+
+class BatchWriter(object):
+    '''Background writer committing queued posts in batches.
+
+    A batch is flushed when it holds max_posts posts or its first post has
+    waited max_delay seconds, whichever comes first.
+    '''
+
+    def __init__(self, max_posts=BATCH_MAX_POSTS, max_delay=BATCH_MAX_DELAY):
+        self.max_posts = max_posts
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Started on first use rather than in __init__, so that each server
+        # process forked after EnableWriteBehind gets its own writer.
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run)
+                self.writer.daemon = True
+                self.writer.start()
+
+    def add(self, content):
+        '''Queue a sanitized post and wait until its batch has committed.
+
+        Raises the batch's error if it could not be saved.
+        '''
+        self.start()
+        entry = {'content': content, 'done': threading.Event(), 'error': None}
+        self.queue.put(entry)
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_posts:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            error = None
+            try:
+                InsertPosts([entry['content'] for entry in batch])
+            except Exception as e:
+                error = e
+            for entry in batch:
+                entry['error'] = error
+                entry['done'].set()
+
+## Background writer used by AddPost, or None to insert each post directly
+_writer = None
+
+def EnableWriteBehind(max_posts=BATCH_MAX_POSTS, max_delay=BATCH_MAX_DELAY):
+    '''Make AddPost group posts arriving together into one transaction.'''
+    global _writer
+    _writer = BatchWriter(max_posts, max_delay)
+
+# Characters bleach.clean changes: markup, and control characters other
+# than tab and newline.  Text without any of them is returned unchanged.
+_NEEDS_CLEANING = re.compile(r'[\x00-\x08\x0b-\x1f&<>]')
+
+# Number of sanitized posts remembered, keyed by a hash of their content
+SANITIZE_MEMO_SIZE = 1024
+
+_sanitized = collections.OrderedDict()
+_sanitized_lock = threading.Lock()
+# bleach Cleaners are not thread-safe, so each thread builds its own
+_cleaners = threading.local()
+
+## Sanitize a post's content.
+def Sanitize(content):
+    '''Return content cleaned of disallowed markup, like bleach.clean.
+
+    Plain text is returned as it is, and the results for recently seen
+    content are remembered, so repeated posts are only cleaned once.
+    '''
+    if not _NEEDS_CLEANING.search(content):
+        return content
+    if isinstance(content, unicode):
+        key = hashlib.sha1(content.encode('utf-8')).digest()
+    else:
+        key = hashlib.sha1(content).digest()
+    with _sanitized_lock:
+        clean = _sanitized.pop(key, None)
+        if clean is not None:
+            _sanitized[key] = clean
+            return clean
+    cleaner = getattr(_cleaners, 'cleaner', None)
+    if cleaner is None:
+        cleaner = _cleaners.cleaner = bleach.sanitizer.Cleaner()
+    clean = cleaner.clean(content)
+    with _sanitized_lock:
+        _sanitized[key] = clean
+        while len(_sanitized) > SANITIZE_MEMO_SIZE:
+            _sanitized.popitem(last=False)
+    return clean
 
 ## Add a post to the database.
 def AddPost(content):
     '''Add a new post to the database.
 
+    Returns once the post is committed.  In write-behind mode the post is
+    committed together with the others that arrived within the batch window.
+
     Args:
       content: The text content of the new post.
     '''
-    content = bleach.clean(content)
-    db = getConnection()
-    cur = db.cursor()
-    cur.execute("insert into posts values (%s)", (content,))
-    db.commit()
-    db.close()
+    content = Sanitize(content)
+    if _writer is not None:
+        _writer.add(content)
+    else:
+        InsertPosts([content])
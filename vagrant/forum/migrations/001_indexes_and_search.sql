@@ -0,0 +1,21 @@
+-- Brings a database created from an older forum.sql up to date with the
+-- paging indexes and full-text search.  Run it once:
+--
+--   psql forum -f migrations/001_indexes_and_search.sql
+
+BEGIN;
+
+CREATE UNIQUE INDEX posts_id_idx ON posts (id);
+CREATE INDEX posts_time_id_idx ON posts (time, id);
+
+ALTER TABLE posts ADD COLUMN search TSVECTOR;
+UPDATE posts SET search = to_tsvector('pg_catalog.english', coalesce(content, ''));
+
+CREATE TRIGGER posts_search_update BEFORE INSERT OR UPDATE ON posts
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(search, 'pg_catalog.english', content);
+CREATE INDEX posts_search_idx ON posts USING gin (search);
+
+ANALYZE posts;
+
+COMMIT;
@@ -0,0 +1,42 @@
+-- Brings a database created from an older tournament.sql up to date with
+-- the indexes and the tournaments.num_players counter.  Run it once:
+--
+--   psql tournament -f migrations/001_indexes_and_player_counts.sql
+
+BEGIN;
+
+CREATE INDEX players_tournament_idx ON players (tournament_id);
+CREATE INDEX matches_tournament_idx ON matches (tournament_id, winner, loser);
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+
+ALTER TABLE tournaments ADD COLUMN num_players integer NOT NULL DEFAULT 0;
+
+UPDATE tournaments SET num_players = counts.num
+FROM (SELECT tournament_id, count(*) AS num FROM players
+      GROUP BY tournament_id) AS counts
+WHERE tournaments.id = counts.tournament_id;
+
+CREATE FUNCTION count_tournament_players() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players - 1
+        WHERE id = OLD.tournament_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players + 1
+        WHERE id = NEW.tournament_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_count_tournament_players
+    AFTER INSERT OR DELETE OR UPDATE OF tournament_id ON players
+    FOR EACH ROW EXECUTE PROCEDURE count_tournament_players();
+
+ANALYZE tournaments;
+ANALYZE players;
+ANALYZE matches;
+
+COMMIT;
@@ -0,0 +1,72 @@
+-- Adds the standings table maintained by triggers on players and matches,
+-- filled from the existing history.  Run it once, after 001:
+--
+--   psql tournament -f migrations/002_standings.sql
+
+BEGIN;
+
+-- Win and match counts per player, maintained by triggers on players and
+-- matches so standings are read instead of aggregated from matches.
+CREATE TABLE standings (
+    player_id integer PRIMARY KEY REFERENCES players(id) ON DELETE CASCADE,
+    tournament_id integer,
+    wins integer NOT NULL DEFAULT 0,
+    matches integer NOT NULL DEFAULT 0
+);
+
+CREATE INDEX standings_tournament_idx ON standings (tournament_id, wins DESC, player_id);
+
+CREATE FUNCTION init_player_standings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO standings (player_id, tournament_id)
+        VALUES (NEW.id, NEW.tournament_id);
+    ELSE
+        UPDATE standings SET tournament_id = NEW.tournament_id
+        WHERE player_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_init_standings
+    AFTER INSERT OR UPDATE OF tournament_id ON players
+    FOR EACH ROW EXECUTE PROCEDURE init_player_standings();
+
+-- Both players of a match are updated by one statement, which locks their
+-- rows in index order so concurrent reports cannot deadlock.
+CREATE FUNCTION record_match_standings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE standings
+        SET wins = wins - (player_id = OLD.winner)::integer, matches = matches - 1
+        WHERE player_id IN (OLD.winner, OLD.loser);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE standings
+        SET wins = wins + (player_id = NEW.winner)::integer, matches = matches + 1
+        WHERE player_id IN (NEW.winner, NEW.loser);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_record_standings
+    AFTER INSERT OR DELETE OR UPDATE OF winner, loser ON matches
+    FOR EACH ROW EXECUTE PROCEDURE record_match_standings();
+
+INSERT INTO standings (player_id, tournament_id, wins, matches)
+SELECT players.id, players.tournament_id,
+       coalesce(records.wins, 0), coalesce(records.matches, 0)
+FROM players
+LEFT OUTER JOIN (
+    SELECT player, sum(won) AS wins, count(*) AS matches
+    FROM (SELECT winner AS player, 1 AS won FROM matches
+          UNION ALL
+          SELECT loser AS player, 0 AS won FROM matches) AS results
+    GROUP BY player
+) AS records ON records.player = players.id;
+
+ANALYZE standings;
+
+COMMIT;
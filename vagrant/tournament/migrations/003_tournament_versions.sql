@@ -0,0 +1,51 @@
+-- Adds tournaments.version, bumped by triggers whenever a tournament's
+-- players or matches change, so tournament.py can tell when a tournament it
+-- holds in memory was changed by another process.  Run it once, after 002:
+--
+--   psql tournament -f migrations/003_tournament_versions.sql
+
+BEGIN;
+
+ALTER TABLE tournaments ADD COLUMN version integer NOT NULL DEFAULT 0;
+
+-- Keeps tournaments.num_players equal to the number of players registered
+-- in the tournament, so the capacity check on registration is O(1).  Also
+-- bumps the tournament's version, which changes whenever its players or
+-- matches do.
+CREATE OR REPLACE FUNCTION count_tournament_players() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players - 1, version = version + 1
+        WHERE id = OLD.tournament_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players + 1, version = version + 1
+        WHERE id = NEW.tournament_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Bumps the version of the tournament of a changed match, so copies of a
+-- tournament held in memory can tell that they are out of date.
+CREATE FUNCTION bump_tournament_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE tournaments SET version = version + 1 WHERE id = OLD.tournament_id;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        UPDATE tournaments SET version = version + 1 WHERE id = NEW.tournament_id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.tournament_id IS DISTINCT FROM OLD.tournament_id THEN
+            UPDATE tournaments SET version = version + 1 WHERE id = NEW.tournament_id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_bump_tournament_version
+    AFTER INSERT OR DELETE OR UPDATE ON matches
+    FOR EACH ROW EXECUTE PROCEDURE bump_tournament_version();
+
+COMMIT;
@@ -0,0 +1,163 @@
+-- Partitions matches by tournament, moving the existing matches into their
+-- partitions.  Run it once, after 003:
+--
+--   psql tournament -f migrations/004_partition_matches.sql
+
+BEGIN;
+
+-- Matches are partitioned by tournament: the matches table stays empty and
+-- each block of match_partition_size() tournaments has its matches in a
+-- child table, matches_<block>, created with the block's first tournament.
+-- Queries on matches read every partition; with tournament_id = constant,
+-- constraint exclusion reads only one.  A finished block is archived by
+-- detaching its partition (see tournament.archiveMatches).
+CREATE FUNCTION match_partition_size() RETURNS integer AS $$
+    SELECT 1000
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION match_partition(integer) RETURNS text AS $$
+    SELECT 'matches_' || ($1 / match_partition_size())
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Creates the partition holding the matches of a tournament, with the
+-- constraints, indexes and triggers of matches, unless it exists already.
+CREATE FUNCTION create_match_partition(tournament integer) RETURNS text AS $$
+DECLARE
+    partition text := match_partition(tournament);
+    low integer := tournament / match_partition_size() * match_partition_size();
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class
+               WHERE relname = partition AND pg_table_is_visible(oid)) THEN
+        RETURN partition;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (
+                        PRIMARY KEY (id),
+                        CHECK (tournament_id >= %s AND tournament_id < %s),
+                        FOREIGN KEY (tournament_id) REFERENCES tournaments(id),
+                        FOREIGN KEY (winner) REFERENCES players(id),
+                        FOREIGN KEY (loser) REFERENCES players(id)
+                    ) INHERITS (matches)',
+                   partition, low, low + match_partition_size());
+    EXECUTE format('CREATE INDEX ON %I (tournament_id, winner, loser)', partition);
+    EXECUTE format('CREATE INDEX ON %I (winner)', partition);
+    EXECUTE format('CREATE INDEX ON %I (loser)', partition);
+    EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR DELETE OR UPDATE OF winner, loser
+                    ON %I FOR EACH ROW EXECUTE PROCEDURE record_match_standings()',
+                   partition || '_record_standings', partition);
+    EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR DELETE OR UPDATE
+                    ON %I FOR EACH ROW EXECUTE PROCEDURE bump_tournament_version()',
+                   partition || '_bump_tournament_version', partition);
+    RETURN partition;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION create_tournament_match_partition() RETURNS trigger AS $$
+BEGIN
+    PERFORM create_match_partition(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournaments_create_match_partition
+    AFTER INSERT ON tournaments
+    FOR EACH ROW EXECUTE PROCEDURE create_tournament_match_partition();
+
+-- Sends each match inserted into matches to its tournament's partition.
+CREATE FUNCTION route_match() RETURNS trigger AS $$
+BEGIN
+    IF NEW.tournament_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT ($1).*', match_partition(NEW.tournament_id))
+    USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Records a match, taking the tournament from the winner.  A routed insert
+-- returns no rows, so this returns the tournament and its version from
+-- before the match; no row if the winner is unknown.
+CREATE FUNCTION report_match(match_winner integer, match_loser integer)
+RETURNS TABLE (match_tournament integer, tournament_version integer) AS $$
+BEGIN
+    SELECT players.tournament_id, tournaments.version
+    INTO match_tournament, tournament_version
+    FROM players JOIN tournaments ON tournaments.id = players.tournament_id
+    WHERE players.id = match_winner;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    INSERT INTO matches (tournament_id, winner, loser)
+    VALUES (match_tournament, match_winner, match_loser);
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A new, empty matches table takes the place of the old one, keeping its
+-- id sequence.
+ALTER SEQUENCE matches_id_seq OWNED BY NONE;
+ALTER TABLE matches RENAME TO unpartitioned_matches;
+ALTER INDEX matches_pkey RENAME TO unpartitioned_matches_pkey;
+ALTER INDEX matches_tournament_idx RENAME TO unpartitioned_matches_tournament_idx;
+ALTER INDEX matches_winner_idx RENAME TO unpartitioned_matches_winner_idx;
+ALTER INDEX matches_loser_idx RENAME TO unpartitioned_matches_loser_idx;
+ALTER TABLE unpartitioned_matches
+    RENAME CONSTRAINT matches_tournament_id_fkey TO unpartitioned_matches_tournament_id_fkey;
+ALTER TABLE unpartitioned_matches
+    RENAME CONSTRAINT matches_winner_fkey TO unpartitioned_matches_winner_fkey;
+ALTER TABLE unpartitioned_matches
+    RENAME CONSTRAINT matches_loser_fkey TO unpartitioned_matches_loser_fkey;
+
+CREATE TABLE matches (
+    id integer PRIMARY KEY DEFAULT nextval('matches_id_seq'),
+    tournament_id integer REFERENCES tournaments(id),
+    winner integer REFERENCES players(id),
+    loser integer REFERENCES players(id)
+);
+
+ALTER SEQUENCE matches_id_seq OWNED BY matches.id;
+
+CREATE INDEX matches_tournament_idx ON matches (tournament_id, winner, loser);
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+
+CREATE TRIGGER matches_record_standings
+    AFTER INSERT OR DELETE OR UPDATE OF winner, loser ON matches
+    FOR EACH ROW EXECUTE PROCEDURE record_match_standings();
+
+CREATE TRIGGER matches_bump_tournament_version
+    AFTER INSERT OR DELETE OR UPDATE ON matches
+    FOR EACH ROW EXECUTE PROCEDURE bump_tournament_version();
+
+CREATE TRIGGER matches_route
+    BEFORE INSERT ON matches
+    FOR EACH ROW EXECUTE PROCEDURE route_match();
+
+-- The standings already count the existing matches, so they are copied
+-- with the triggers of the partitions disabled.
+DO $$
+DECLARE
+    tournament integer;
+    partition text;
+BEGIN
+    FOR tournament IN SELECT min(id) FROM tournaments GROUP BY id / match_partition_size() LOOP
+        partition := create_match_partition(tournament);
+        EXECUTE format('ALTER TABLE %I DISABLE TRIGGER USER', partition);
+        EXECUTE format('INSERT INTO %I SELECT * FROM unpartitioned_matches
+                        WHERE tournament_id / match_partition_size() = %s',
+                       partition, tournament / match_partition_size());
+        EXECUTE format('ALTER TABLE %I ENABLE TRIGGER USER', partition);
+    END LOOP;
+END;
+$$;
+
+-- Matches without a tournament stay in matches itself
+ALTER TABLE matches DISABLE TRIGGER USER;
+INSERT INTO matches SELECT * FROM unpartitioned_matches WHERE tournament_id IS NULL;
+ALTER TABLE matches ENABLE TRIGGER USER;
+
+DROP TABLE unpartitioned_matches;
+
+ANALYZE matches;
+
+COMMIT;
@@ -3,56 +3,472 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import array
+import contextlib
+import itertools
+import math
+import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+# dbstats.py is shared with the forum, one directory up; the scripts using
+# this module put that directory on sys.path.
+import dbstats
+
+dbstats.register(__name__)
+
+DSN = "dbname=tournament"
+
+# Bounds of the module-level connection pool.  Callers beyond the maximum
+# wait for a connection to be returned instead of opening new ones.
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 8
+
+# Pooled connections idle for longer than this many seconds are checked
+# with a round trip before they are handed out.
+POOL_PING_AFTER_IDLE = 30.0
+
+# Maximum number of players registered in a single tournament
+TOURNAMENT_CAPACITY = 8
+
+# Rounds of a full tournament: enough to find a single winner.  A tournament
+# is finished once each of its players has played this many matches.
+SWISS_ROUNDS = int(math.ceil(math.log(TOURNAMENT_CAPACITY, 2)))
+
+# Advisory lock key serializing registrations, so two concurrent
+# registrations cannot both take the last seat of a tournament.
+REGISTRATION_LOCK = 0x746f75726e
+
+# Lowest match-win percentage counted for an opponent in the opponents'
+# match-win percentage tiebreaker, as in most Swiss rules.
+MATCH_WIN_FLOOR = 1.0 / 3
+
+# Seconds the memory engine trusts a tournament it holds before checking its
+# version in the database again.  Writes made through this module are seen
+# at once; writes made by other processes within this many seconds.
+MEMORY_ENGINE_CHECK_INTERVAL = 1.0
+
+_pool = None
+_pool_lock = threading.Lock()
+_engine = None
+
+# Tournaments whose matches share a partition, as match_partition_size() in
+# tournament.sql.
+MATCH_PARTITION_SIZE = 1000
+
+# Statements shared by the global and per-tournament functions, as (column,
+# query) pairs.  Each is prepared on the server in two variants: %(filter)s
+# becomes "true", or "column = $1" to restrict it to one tournament, and so
+# does the filter of the OPPONENTS joined in by %(opponents)s.  The
+# per-tournament variants of the PARTITIONED_STATEMENTS are prepared once per
+# partition of matches; see _statementQuery().
+STATEMENTS = {
+    'count_players': ("id", """
+        select coalesce(sum(num_players), 0) from tournaments
+        where %(filter)s"""),
+    'standings': ("standings.tournament_id", """
+        select players.id, players.name, standings.wins, standings.matches
+        from standings
+        join players on players.id = standings.player_id
+        where %(filter)s
+        order by standings.wins desc, standings.player_id"""),
+    'pairing_standings': ("standings.tournament_id", """
+        select standings.tournament_id, players.id, players.name, standings.wins,
+               coalesce(opponents.ids, '{}') as opponents, coalesce(opponents.byes, 0) as byes
+        from standings
+        join players on players.id = standings.player_id
+        left join (%(opponents)s) as opponents on opponents.player_id = standings.player_id
+        where %(filter)s
+        order by standings.wins desc, standings.player_id"""),
+    'tournament_pairing_standings': ("standings.tournament_id", """
+        select standings.tournament_id, players.id, players.name, standings.wins,
+               coalesce(opponents.ids, '{}') as opponents, coalesce(opponents.byes, 0) as byes
+        from standings
+        join players on players.id = standings.player_id
+        left join (%(opponents)s) as opponents on opponents.player_id = standings.player_id
+        where %(filter)s
+        order by standings.tournament_id, standings.wins desc, standings.player_id"""),
+    'match_edges': ("tournament_id", """
+        select winner, loser from matches
+        where %(filter)s and loser is not null"""),
+}
+
+# The STATEMENTS reading matches
+PARTITIONED_STATEMENTS = frozenset(['pairing_standings', 'tournament_pairing_standings',
+                                    'match_edges'])
+
+# Ids of the players each player has met, and the number of byes they had: a
+# bye is a match with no loser.  Filtered on matches.tournament_id, so the
+# per-tournament variants read a single partition of matches.
+OPPONENTS = """select player_id, array_remove(array_agg(opponent), null) as ids,
+                      count(*) - count(opponent) as byes
+               from (select winner as player_id, loser as opponent from matches
+                     where %(filter)s
+                     union all
+                     select loser, winner from matches
+                     where %(filter)s and loser is not null) as played
+               group by player_id"""
+
+# Per prepared statement: [seconds spent preparing, executions, seconds
+# spent executing], accumulated over every pooled connection.
+_statement_stats = {}
+_statement_stats_lock = threading.Lock()
+
+
+class _PreparingConnection(dbstats.InstrumentedConnection):
+    """A connection that remembers which STATEMENTS it has prepared"""
+
+    def __init__(self, *args, **kwargs):
+        super(_PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.time()
 
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(DSN, connection_factory=dbstats.InstrumentedConnection)
+
+
+def getPool():
+    """Returns the module-level connection pool, creating it on first use.
+
+    The pool is sized from POOL_MIN_CONNECTIONS and POOL_MAX_CONNECTIONS as
+    they are when it is created.  Its slots semaphore, created with it from
+    the same maximum, makes callers wait for a connection rather than fail.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, DSN,
+                connection_factory=_PreparingConnection)
+            pool.slots = threading.BoundedSemaphore(pool.maxconn)
+            _pool = pool
+        return _pool
+
+
+def closePool():
+    """Closes every pooled connection.  The pool is recreated on next use."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def _isAlive(db):
+    """True if the server has not dropped a pooled connection.
+
+    Only if dbstats.isDropped() suspects it did, or after the connection sat
+    idle for POOL_PING_AFTER_IDLE seconds, is the server asked to answer.
+    """
+    if not dbstats.isDropped(db) and time.time() - db.last_used < POOL_PING_AFTER_IDLE:
+        return True
+    c = psycopg2.extensions.cursor(db)
+    try:
+        c.execute("select 1")
+        db.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+    finally:
+        c.close()
+
+
+def _checkout(pool):
+    """Takes a healthy connection out of the pool, replacing dead ones"""
+    for _ in range(pool.maxconn + 1):
+        db = pool.getconn()
+        if not dbstats.isBroken(db) and _isAlive(db):
+            return db
+        pool.putconn(db, close=True)
+    raise psycopg2.OperationalError("no healthy connection available in pool")
+
+
+def _executeValues(c, query, rows, template, page_size=1000):
+    """Runs query once per page of rows, with its %s replaced by a VALUES list.
+
+    This is what psycopg2.extras.execute_values does; the psycopg2 shipped
+    with the Vagrant box predates it.  Returns the rows fetched from any
+    RETURNING clause.  Works on Python 3 too, where mogrify returns bytes.
+    """
+    results = []
+    for start in range(0, len(rows), page_size):
+        page = rows[start:start + page_size]
+        values = b','.join(c.mogrify(template, row) for row in page)
+        c.execute(query.encode('utf-8') % values)
+        if c.description is not None:
+            results.extend(c.fetchall())
+    return results
+
+
+def _recordStatement(statement, prepare=0.0, execute=None):
+    """Adds a prepare or execute duration to the statement's timings"""
+    with _statement_stats_lock:
+        stats = _statement_stats.setdefault(statement, [0.0, 0, 0.0])
+        stats[0] += prepare
+        if execute is not None:
+            stats[1] += 1
+            stats[2] += execute
+
+
+def statementStats():
+    """Returns the timings of the prepared STATEMENTS.
+
+    Returns:
+      A dict mapping each statement name to a (prepare_seconds, executions,
+      execute_seconds) tuple, covering every connection since the last reset.
+    """
+    with _statement_stats_lock:
+        return dict((name, tuple(stats)) for (name, stats) in _statement_stats.items())
+
+
+def resetStatementStats():
+    """Clears the timings returned by statementStats()."""
+    with _statement_stats_lock:
+        _statement_stats.clear()
+
+
+def _statementQuery(name, tournament_id=None):
+    """Returns the name and SQL of the variant of one of the STATEMENTS.
+
+    The filters of a per-tournament variant reading matches also bound the
+    tournament by the constant range of its partition.  The server may run a
+    prepared statement with a generic plan, built without knowing $1, and
+    only constants let that plan skip the other partitions.
+    """
+    column, query = STATEMENTS[name]
+    if tournament_id is None:
+        return name, query % {'filter': 'true',
+                              'opponents': OPPONENTS % {'filter': 'true'}}
+    statement = name + '_for_tournament'
+    bounds = ''
+    if name in PARTITIONED_STATEMENTS:
+        block = tournament_id // MATCH_PARTITION_SIZE
+        statement += '_%d' % block
+        bounds = ' and %%(column)s >= %d and %%(column)s < %d' % (
+            block * MATCH_PARTITION_SIZE, (block + 1) * MATCH_PARTITION_SIZE)
+    restrict = '%(column)s = $1' + bounds
+    return statement, query % {'filter': restrict % {'column': column},
+                               'opponents': OPPONENTS % {
+                                   'filter': restrict % {'column': 'tournament_id'}}}
+
+
+def _execute(c, name, tournament_id=None):
+    """Executes one of the STATEMENTS, optionally for a single tournament.
+
+    Each variant is prepared once per pooled connection, so repeated calls
+    skip parsing and planning on the server.
+    """
+    statement, query = _statementQuery(name, tournament_id)
+    prepared = c.connection.prepared
+    if statement not in prepared:
+        start = time.time()
+        c.execute("prepare %s as %s" % (statement, query))
+        prepared.add(statement)
+        _recordStatement(statement, prepare=time.time() - start)
+    start = time.time()
+    if tournament_id is None:
+        c.execute("execute " + statement)
+    else:
+        c.execute("execute " + statement + " (%s)", (tournament_id,))
+    _recordStatement(statement, execute=time.time() - start)
+
+
+@contextlib.contextmanager
+def transaction():
+    """Checks a connection out of the pool and yields a cursor on it.
+
+    The transaction is committed when the block exits normally and rolled
+    back if it raises.  The connection always goes back to the pool, or is
+    discarded if the server dropped it.
+    """
+    pool = getPool()
+    pool.slots.acquire()
+    try:
+        db = _checkout(pool)
+        try:
+            yield db.cursor()
+            db.commit()
+        except Exception:
+            if not dbstats.isBroken(db):
+                try:
+                    db.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            db.last_used = time.time()
+            pool.putconn(db, close=dbstats.isBroken(db))
+    finally:
+        pool.slots.release()
 
 
 def deleteMatches():
     """Remove all the match records from the database."""
-    db = connect()
-    c = db.cursor()
-    query = "delete from matches;"
-    c.execute(query)
-    db.commit()
+    # Emptying the partitions skips the triggers on matches, so the
+    # standings and versions they maintain are reset here.
+    with transaction() as c:
+        c.execute("truncate matches")
+        c.execute("update standings set wins = 0, matches = 0 where matches > 0")
+        c.execute("update tournaments set version = version + 1")
+    _forgetTournaments()
+
+
+def archiveMatches(tournament_id, drop=False):
+    """Moves the matches of finished tournaments out of the matches table.
+
+    The partition holding tournament_id's matches, which also holds those of
+    the other tournaments in its block, is detached from matches and moved
+    to archived_matches_<block>, or dropped.  Every tournament of the block
+    must be finished: full, with each player having played SWISS_ROUNDS
+    matches.  The archived table refers to no players or tournaments, so
+    they can still be deleted.  Standings keep the players' final records,
+    and an empty partition takes the place of the archived one, for
+    tournaments added to the block later.
+
+    Args:
+      tournament_id: a tournament of the block to archive
+      drop: drop the matches instead of keeping the archived table
+
+    Returns:
+      The name of the archived table, or None if it was dropped.
+    """
+    with transaction() as c:
+        c.execute("""select match_partition(%s), match_partition_size(),
+                            %s / match_partition_size() * match_partition_size()""",
+                  (tournament_id, tournament_id))
+        partition, size, low = c.fetchone()
+        # Detached first, so no match can be reported after the check
+        c.execute("alter table %s no inherit matches" % partition)
+        c.execute("""select tournaments.id from tournaments
+                     left join standings on standings.tournament_id = tournaments.id
+                     where tournaments.id >= %(low)s and tournaments.id < %(high)s
+                     group by tournaments.id
+                     having tournaments.num_players < %(capacity)s
+                         or coalesce(min(standings.matches), 0) < %(rounds)s
+                     order by tournaments.id""",
+                  {'low': low, 'high': low + size,
+                   'capacity': TOURNAMENT_CAPACITY, 'rounds': SWISS_ROUNDS})
+        running = [running_id for (running_id,) in c.fetchall()]
+        if running:
+            raise ValueError("Tournaments {ids} of the block are not finished".format(ids=running))
+        archived = 'archived_' + partition
+        c.execute("""select exists (select 1 from pg_class
+                                    where relname = %s and pg_table_is_visible(oid))""",
+                  (archived,))
+        if drop:
+            c.execute("drop table %s" % partition)
+            archived = None
+        elif c.fetchone()[0]:
+            # The block was archived before
+            c.execute("insert into %s select * from %s" % (archived, partition))
+            c.execute("drop table %s" % partition)
+        else:
+            _detachMatchPartition(c, partition, archived)
+        c.execute("select create_match_partition(%s)", (low,))
+        c.execute("""update tournaments set version = version + 1
+                     where id >= %s and id < %s""", (low, low + size))
+    _forgetTournaments()
+    return archived
+
+
+def _detachMatchPartition(c, partition, archived):
+    """Renames a detached partition and drops its foreign keys and triggers.
+
+    Its indexes are renamed along with it, so the partition that replaces it
+    gets the usual index names.
+    """
+    c.execute("""select conname from pg_constraint
+                 where conrelid = %s::regclass and contype = 'f'""", (partition,))
+    for (constraint,) in c.fetchall():
+        c.execute('alter table %s drop constraint "%s"' % (partition, constraint))
+    c.execute("""select tgname from pg_trigger
+                 where tgrelid = %s::regclass and not tgisinternal""", (partition,))
+    for (trigger,) in c.fetchall():
+        c.execute('drop trigger "%s" on %s' % (trigger, partition))
+    c.execute("""select indexrelid::regclass::text from pg_index
+                 where indrelid = %s::regclass""", (partition,))
+    for (index,) in c.fetchall():
+        c.execute('alter index "%s" rename to "archived_%s"' % (index, index))
+    c.execute("alter table %s rename to %s" % (partition, archived))
 
 
 def deletePlayers():
     """Remove all the player records from the database."""
-    db = connect()
-    c = db.cursor()
-    query = "DELETE FROM players"
-    c.execute(query)
-    db.commit()
+    with transaction() as c:
+        c.execute("lock table players, matches in share row exclusive mode")
+        c.execute("select exists (select 1 from matches)")
+        if c.fetchone()[0]:
+            # Fails on the foreign keys of the matches, as before
+            query = "DELETE FROM players"
+            c.execute(query)
+        else:
+            # Deleting row by row would check every partition of matches
+            # for every player; truncating skips the triggers on players,
+            # so the player counts they maintain are reset here.
+            c.execute("truncate players, standings, matches")
+            c.execute("""update tournaments set num_players = 0, version = version + 1
+                         where num_players > 0""")
+    _forgetTournaments()
 
 def deleteTournaments():
     """remove all tournaments from database"""
-    db = connect()
-    c = db.cursor()
-    query = "DELETE FROM tournaments"
-    c.execute(query)
-    db.commit()
-
-def countPlayers():
-    """Returns the number of players currently registered."""
-    db = connect()
-    c = db.cursor()
-    query = "select count(*)as num from players"
-    c.execute(query)
-    num_players = c.fetchone()[0]
-    return num_players
+    with transaction() as c:
+        c.execute("lock table tournaments, players, matches in share row exclusive mode")
+        c.execute("select exists (select 1 from players) or exists (select 1 from matches)")
+        referenced = c.fetchone()[0]
+        if referenced:
+            # Fails on the foreign keys of players and matches, as before
+            query = "DELETE FROM tournaments"
+            c.execute(query)
+        # The tournaments' match partitions, which are empty by now, go with
+        # them.
+        c.execute("""select inhrelid::regclass::text from pg_inherits
+                     where inhparent = 'matches'::regclass""")
+        for (partition,) in c.fetchall():
+            c.execute("drop table %s" % partition)
+        if not referenced:
+            # Nothing refers to the tournaments, so they can be truncated
+            # instead of deleted row by row.
+            c.execute("truncate tournaments, players, standings, matches")
+    _forgetTournaments()
+
+def countPlayers(tournament_id=None):
+    """Returns the number of players currently registered.
+
+    Args:
+      tournament_id: only count the players registered in this tournament
+    """
+    with transaction() as c:
+        _execute(c, 'count_players', tournament_id)
+        num_players = c.fetchone()[0]
+        return num_players
 
 def countPlayersInTournament(tournament_id):
     """Returns the number of players currently registered in a tournament."""
-    db = connect()
-    c = db.cursor()
-    query = "select count(*)as num from players where tournament_id = %s"
-    c.execute(query, (tournament_id,))
-    num_players = c.fetchone()[0]
-    return num_players
+    return countPlayers(tournament_id)
+
+# Finds the newest tournament with a free seat, creating one if there is
+# none, and registers the player in it -- all in a single statement.
+REGISTER_PLAYER_QUERY = """
+    with open_tournament as (
+        select id from tournaments
+        where id = (select max(id) from tournaments)
+          and num_players < %(capacity)s
+    ), new_tournament as (
+        insert into tournaments (created)
+        select now() where not exists (select 1 from open_tournament)
+        returning id
+    )
+    insert into players (name, tournament_id)
+    select %(name)s, id from open_tournament
+    union all
+    select %(name)s, id from new_tournament
+    """
 
 def registerPlayer(name):
     """Adds a player to the tournament database.
@@ -63,70 +479,100 @@ def registerPlayer(name):
     Args:
       name: the player's full name (need not be unique).
     """
-    tournament_id = retrieveTournamentId()
-    db = connect()
-    c = db.cursor()
-    query = "insert into players values (DEFAULT,%s,%s)"
-    c.execute(query, (name, str(tournament_id),))
-    db.commit()
+    with transaction() as c:
+        c.execute("select pg_advisory_xact_lock(%s)", (REGISTRATION_LOCK,))
+        c.execute(REGISTER_PLAYER_QUERY,
+                  {'name': name, 'capacity': TOURNAMENT_CAPACITY})
+    _forgetTournaments()
+
+def registerPlayers(names):
+    """Registers many players in one transaction.
+
+    Works like calling registerPlayer() for each name in order: the open
+    tournament is filled first and new tournaments are created as needed,
+    TOURNAMENT_CAPACITY players at a time.
+
+    Args:
+      names: the players' full names.
+
+    Returns:
+      The new players' ids, in the same order as names.
+    """
+    names = list(names)
+    if not names:
+        return []
+    with transaction() as c:
+        c.execute("select pg_advisory_xact_lock(%s)", (REGISTRATION_LOCK,))
+        c.execute("""select id, num_players from tournaments
+                     where id = (select max(id) from tournaments)""")
+        open_tournament = c.fetchone()
+        seats = []
+        if open_tournament:
+            tournament_id, num_players = open_tournament
+            seats = [tournament_id] * max(TOURNAMENT_CAPACITY - num_players, 0)
+        missing = len(names) - len(seats)
+        if missing > 0:
+            num_tournaments = (missing + TOURNAMENT_CAPACITY - 1) // TOURNAMENT_CAPACITY
+            c.execute("""insert into tournaments (created)
+                         select now() from generate_series(1, %s)
+                         returning id""", (num_tournaments,))
+            for (tournament_id,) in sorted(c.fetchall()):
+                seats.extend([tournament_id] * TOURNAMENT_CAPACITY)
+        rows = list(zip(names, seats))
+        player_ids = _executeValues(
+            c, "insert into players (name, tournament_id) values %s returning id",
+            rows, "(%s,%s)")
+    _forgetTournaments()
+    return [player_id for (player_id,) in player_ids]
 
 def retrieveLastPlayerTournamentId():
     """Fetch the tournament_id of the last added player"""
-    db = connect()
-    c = db.cursor()
-    query = "select tournament_id from players order by id desc"
-    c.execute(query)
-    tournament_id = c.fetchone()[0]
-    return tournament_id
+    with transaction() as c:
+        query = "select tournament_id from players order by id desc limit 1"
+        c.execute(query)
+        tournament_id = c.fetchone()[0]
+        return tournament_id
 
 def retrieveAllTournamentId():
     """Retrieves a list of all the tournament_ids"""
-    db = connect()
-    c = db.cursor()
-    query = "select id from tournaments order by id"
-    c.execute(query)
-    tournaments = c.fetchall()
-    return tournaments
+    with transaction() as c:
+        query = "select id from tournaments order by id"
+        c.execute(query)
+        tournaments = c.fetchall()
+        return tournaments
 
 def retrieveTournamentId():
     """Retrieve tournament id of ongoing tournament or creates a new one"""
-    db = connect()
-    c = db.cursor()
-    query_tournament = "select id from tournaments order by id desc"
-    query_count_player_for_tournament = "select count(*) from players where tournament_id = %s"
-
-    #Check if existing tournament
-    c.execute(query_tournament)
-    tournament_id = c.fetchone()
-    if not tournament_id:
-        #create new tournament
-        tournament_id = createTournament()
-        return tournament_id
-    else:
-        c.execute(query_count_player_for_tournament,(tournament_id,))
-        num_players = c.fetchone()[0]
-        if num_players >= 8: # Assuming max number of players in a tournament as 8
-            #create new tournament
-            tournament_id = createTournament()
-            return tournament_id
-        return tournament_id[0]
+    with transaction() as c:
+        query_tournament = "select id, num_players from tournaments order by id desc limit 1"
+
+        #Check if existing tournament
+        c.execute(query_tournament)
+        tournament = c.fetchone()
+        if tournament:
+            tournament_id, num_players = tournament
+            if num_players < TOURNAMENT_CAPACITY:
+                return tournament_id
+    # Create the new tournament once the connection above is back in the pool
+    return createTournament()
 
 def createTournament():
     """Creates a new tournament"""
-    db = connect()
-    c = db.cursor()
-    query_new_tournament = "insert into tournaments values (DEFAULT) returning id"
-    c.execute(query_new_tournament)
-    tournament_id = c.fetchone()[0]
-    db.commit()
-    return tournament_id
-
-def playerStandings():
+    with transaction() as c:
+        query_new_tournament = "insert into tournaments values (DEFAULT) returning id"
+        c.execute(query_new_tournament)
+        tournament_id = c.fetchone()[0]
+        return tournament_id
+
+def playerStandings(tournament_id=None):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a player
     tied for first place if there is currently a tie.
 
+    Args:
+      tournament_id: only include the players of this tournament
+
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
@@ -134,76 +580,312 @@ def playerStandings():
         wins: the number of matches the player has won
         matches: the number of matches the player has played
     """
-    standings = []
-    db = connect()
-    c = db.cursor()
-    query = """
-       select players.id, players.name, count(m1.id) as wins, count(m2.id) as matches
-       from players
-       left outer join matches as m1 on players.id = m1.winner
-       left outer join matches as m2 on players.id = m2.winner or players.id = m2.loser
-       group by players.id
-       order by wins desc
-       """
-    c.execute(query)
-    for player in c.fetchall():
-        standings.append(player)
-    #posts = [{'content': str(row[1]), 'time': str(row[0])} for row in cur.fetchall()]
-    return standings
+    # The standings table is kept up to date by triggers on matches
+    with transaction() as c:
+        _execute(c, 'standings', tournament_id)
+        return c.fetchall()
 
 def playerStandingsForTournament(tournament_id):
-    """Works like playerStandings() but for a selected tournament"""
-    standings = []
-    db = connect()
-    c = db.cursor()
-    query = """
-       select players.id, players.name, count(m1.id) as wins, count(m2.id) as matches
-       from players
-       left outer join matches as m1 on players.id = m1.winner
-       left outer join matches as m2 on players.id = m2.winner or players.id = m2.loser
-       where players.tournament_id = %s
-       group by players.id
-       order by wins desc
-       """
-    c.execute(query, (tournament_id,))
-    for player in c.fetchall():
-        standings.append(player)
-    return standings
+    """Works like playerStandings() but for a selected tournament
+
+    Served from memory when the memory engine is enabled.
+    """
+    if _engine is not None:
+        return _engine.standings(tournament_id)
+    return playerStandings(tournament_id)
+
+def playerStandingsWithTiebreaks(tournament_id=None):
+    """Returns the standings with ties broken by Buchholz and opponents'
+    match-win percentage.
+
+    The standings and the list of matches are read once; the tiebreakers
+    are computed with NumPy, which must be installed.
+
+    Args:
+      tournament_id: only include the players of this tournament
+
+    Returns:
+      A list of (id, name, wins, matches, buchholz, omw) tuples, sorted by
+      wins, then buchholz, then omw, all descending:
+        buchholz: the total wins of the player's opponents
+        omw: the average match-win percentage of the player's opponents,
+          each counted as at least MATCH_WIN_FLOOR; 0.0 before any match
+    """
+    with transaction() as c:
+        _execute(c, 'standings', tournament_id)
+        standings = c.fetchall()
+        _execute(c, 'match_edges', tournament_id)
+        edges = c.fetchall()
+    return _tiebreakStandings(standings, edges)
+
+def _tiebreakStandings(standings, edges):
+    """Adds tiebreakers to (id, name, wins, matches) rows and sorts them"""
+    import numpy
+    if not standings:
+        return []
+    standings = sorted(standings)
+    ids = numpy.array([row[0] for row in standings])
+    wins = numpy.array([row[2] for row in standings], dtype=float)
+    matches = numpy.array([row[3] for row in standings], dtype=float)
+    if edges:
+        winners, losers = numpy.array(edges).T
+    else:
+        winners = losers = numpy.zeros(0, dtype=ids.dtype)
+    # Positions of each match's players in the arrays above
+    w = numpy.searchsorted(ids, winners).clip(0, len(ids) - 1)
+    l = numpy.searchsorted(ids, losers).clip(0, len(ids) - 1)
+    known = (ids[w] == winners) & (ids[l] == losers)
+    w, l = w[known], l[known]
+    n = len(ids)
+    # Each match adds the loser's value to the winner and vice versa
+    buchholz = (numpy.bincount(w, weights=wins[l], minlength=n) +
+                numpy.bincount(l, weights=wins[w], minlength=n))
+    win_rate = numpy.maximum(wins / numpy.maximum(matches, 1), MATCH_WIN_FLOOR)
+    # Byes are matches without an opponent, so they are not averaged in
+    opponents = numpy.bincount(w, minlength=n) + numpy.bincount(l, minlength=n)
+    omw = ((numpy.bincount(w, weights=win_rate[l], minlength=n) +
+            numpy.bincount(l, weights=win_rate[w], minlength=n)) /
+           numpy.maximum(opponents, 1))
+    order = numpy.lexsort((ids, -omw, -buchholz, -wins))
+    return [standings[i] + (int(buchholz[i]), float(omw[i])) for i in order]
 
 def reportMatch(winner, loser):
     """Records the outcome of a single match between two players.
 
     Args:
       winner:  the id number of the player who won
-      loser:  the id number of the player who lost
-    """
-    db = connect()
-    c = db.cursor()
-    #win_query = "UPDATE players SET matches = matches+1, wins = wins+1 WHERE id = %s"
-    #loss_query = "UPDATE players SET matches = matches+1 WHERE id = %s"
-    match_query = "insert into matches values (default,%s,%s,%s)"
-    tournament_id = player_tournament_id(winner)
-    c.execute(match_query, (tournament_id,winner,loser,))
-    #c.execute(win_query, (winner,))
-    #c.execute(loss_query, (loser,))
-    db.commit()
+      loser:  the id number of the player who lost, or None to record a bye
+        given to winner, which counts as a win
+    """
+    # report_match() takes the match's tournament from the winner and
+    # inserts it into the tournament's partition; the trigger there updates
+    # both players' standings in this transaction.  The tournament's version
+    # from before the triggers bump it lets the memory engine tell whether
+    # its copy was current.
+    with transaction() as c:
+        c.execute("select * from report_match(%s, %s)", (winner, loser))
+        if c.rowcount != 1:
+            raise ValueError("Unknown player id {id}".format(id=winner))
+        tournament_id, version = c.fetchone()
+    if _engine is not None:
+        _engine.recordMatch(tournament_id, winner, loser, version)
+
+def reportMatches(results):
+    """Records the outcomes of many matches in one transaction.
+
+    Either every match is recorded or, if any winner is unknown, none is.
+
+    Args:
+      results: a sequence of (winner, loser) player id pairs; a loser of
+        None records a bye.
+    """
+    results = list(results)
+    if not results:
+        return
+    # The winners' tournaments, and the partitions their matches go to, are
+    # looked up first; the matches are then inserted into each partition
+    # directly rather than routed one by one.
+    tournament_query = """select match_partition(players.tournament_id),
+                                 players.tournament_id, results.winner, results.loser
+                          from (values %s) as results (winner, loser)
+                          join players on players.id = results.winner"""
+    with transaction() as c:
+        matches = _executeValues(c, tournament_query, results, "(%s,%s)")
+        if len(matches) != len(results):
+            raise ValueError("Unknown winner id in reported matches")
+        matches.sort()
+        for partition, group in itertools.groupby(matches, key=lambda row: row[0]):
+            _executeValues(
+                c, "insert into %s (tournament_id, winner, loser) values %%s" % (
+                    partition or "matches"),
+                [row[1:] for row in group], "(%s,%s,%s)")
+    _forgetTournaments()
 
 def player_tournament_id(player_id):
     """Retrieves the tournament_id of the player in the match"""
-    db = connect()
-    c = db.cursor()
-    query = "select tournament_id from players where id = %s"
-    c.execute(query, (player_id,))
-    tournament_id = c.fetchone()[0]
-    return tournament_id
-
-def swissPairings():
+    with transaction() as c:
+        query = "select tournament_id from players where id = %s"
+        c.execute(query, (player_id,))
+        tournament_id = c.fetchone()[0]
+        return tournament_id
+
+# Number of already formed pairs reopened when the greedy pass leaves players
+# of a score group unpaired, and the step budget of the search among them.
+# Players still unpaired at the bottom reopen twice as many pairs at a time,
+# up to PAIRING_MAX_REOPENED_PAIRS, before a rematch is accepted.
+PAIRING_REPAIR_PAIRS = 8
+PAIRING_MAX_REOPENED_PAIRS = 64
+PAIRING_SEARCH_LIMIT = 10000
+
+# With an odd number of players, the lowest ranked players without a bye
+# tried in turn until the others can be paired without a rematch.
+PAIRING_BYE_CANDIDATES = 4
+
+
+def _pairKey(id1, id2):
+    """Key of a pair of player ids in a set of played pairs"""
+    return (id1, id2) if id1 < id2 else (id2, id1)
+
+
+def _pairingArguments(rows):
+    """Splits pairing_standings rows into the arguments of pairPlayers()"""
+    players = [(player_id, name, wins)
+               for (tournament_id, player_id, name, wins, opponents, byes) in rows]
+    played = set(_pairKey(player_id, opponent)
+                 for (tournament_id, player_id, name, wins, opponents, byes) in rows
+                 for opponent in opponents)
+    had_bye = set(player_id
+                  for (tournament_id, player_id, name, wins, opponents, byes) in rows
+                  if byes)
+    return players, played, had_bye
+
+
+def _searchPairs(players, played, limit):
+    """Pairs an even number of players without rematches by backtracking.
+
+    Tries opponents in standings order, so the first solution found keeps
+    players as close to their neighbours as possible.  Returns None if there
+    is no such pairing or it was not found within `limit` steps.
+    """
+    steps = [0]
+
+    def search(remaining):
+        if not remaining:
+            return []
+        first = remaining[0]
+        for k in range(1, len(remaining)):
+            steps[0] += 1
+            if steps[0] > limit:
+                return None
+            other = remaining[k]
+            if _pairKey(first[0], other[0]) in played:
+                continue
+            rest = search(remaining[1:k] + remaining[k + 1:])
+            if rest is not None:
+                return [(first, other)] + rest
+        return None
+
+    return search(players)
+
+
+def _pairGroup(group, played, rank):
+    """Pairs one score group greedily, repairing the tail if that gets stuck.
+
+    Each player is paired with the highest ranked waiting player they have
+    not met yet, which is the adjacent player unless that is a rematch, so
+    the pass is linear when there are few rematches to avoid.  Returns the
+    pairs and the players left over, who float down to the next group.
+    """
+    pairs = []
+    waiting = []
+    for player in group:
+        for k, other in enumerate(waiting):
+            if _pairKey(other[0], player[0]) not in played:
+                del waiting[k]
+                pairs.append((other, player))
+                break
+        else:
+            waiting.append(player)
+    if len(waiting) > 1:
+        # Reopen the last few pairs and search for a rematch-free pairing
+        # among them and the players left waiting.
+        reopened = pairs[-PAIRING_REPAIR_PAIRS:]
+        candidates = [p for pair in reopened for p in pair] + waiting
+        candidates.sort(key=lambda p: rank[p[0]])
+        floater = []
+        if len(candidates) % 2:
+            floater = [candidates.pop()]
+        found = _searchPairs(candidates, played, PAIRING_SEARCH_LIMIT)
+        if found is not None:
+            pairs[-PAIRING_REPAIR_PAIRS:] = found
+            waiting = floater
+    return pairs, waiting
+
+
+def _reopenPairs(pairs, floaters, played, rank):
+    """Pairs the players left at the bottom by reopening earlier pairs.
+
+    Searches for a rematch-free pairing of the floaters and the players of
+    the last PAIRING_REPAIR_PAIRS pairs, then of twice as many pairs, up to
+    PAIRING_MAX_REOPENED_PAIRS or every pair.  Returns the pairs and the
+    players still left, who are empty unless no pairing was found.
+    """
+    size = PAIRING_REPAIR_PAIRS
+    while True:
+        kept = max(len(pairs) - size, 0)
+        candidates = [p for pair in pairs[kept:] for p in pair] + floaters
+        candidates.sort(key=lambda p: rank[p[0]])
+        found = _searchPairs(candidates, played, PAIRING_SEARCH_LIMIT)
+        if found is not None:
+            return pairs[:kept] + found, []
+        if kept == 0 or size >= PAIRING_MAX_REOPENED_PAIRS:
+            return pairs, floaters
+        size *= 2
+
+
+def _pairRound(players, played, rank):
+    """Pairs an even number of players score group by score group.
+
+    Returns the pairs and the number of them that are rematches.
+    """
+    pairs = []
+    floaters = []
+    for wins, group in itertools.groupby(players, key=lambda p: p[2]):
+        group_pairs, floaters = _pairGroup(floaters + list(group), played, rank)
+        pairs.extend(group_pairs)
+    if floaters:
+        pairs, floaters = _reopenPairs(pairs, floaters, played, rank)
+    # Players still left have met every player they could be paired with
+    rematches = list(zip(floaters[0::2], floaters[1::2]))
+    return pairs + rematches, len(rematches)
+
+
+def pairPlayers(players, played=frozenset(), had_bye=frozenset()):
+    """Pairs players for the next Swiss round.
+
+    Players are paired within their score group, avoiding rematches.  Players
+    who cannot be paired within their group float down to the next one.
+    With an odd number of players the lowest ranked player who has not had
+    a bye yet gets one.
+
+    Args:
+      players: a list of (id, name, wins) tuples sorted by standing
+      played: a set of pairs of player ids (lower id first) that have met
+      had_bye: the ids of the players who have had a bye
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples.  A bye is (id, name, None, None).
+    """
+    players = list(players)
+    rank = dict((player[0], i) for (i, player) in enumerate(players))
+    if len(players) % 2 == 0:
+        pairs, rematches = _pairRound(players, played, rank)
+        return [(p1[0], p1[1], p2[0], p2[1]) for (p1, p2) in pairs]
+    candidates = [p for p in reversed(players) if p[0] not in had_bye] or players[::-1]
+    best = None
+    for bye in candidates[:PAIRING_BYE_CANDIDATES]:
+        pairs, rematches = _pairRound([p for p in players if p is not bye], played, rank)
+        if best is None or rematches < best[2]:
+            best = (bye, pairs, rematches)
+        if not rematches:
+            break
+    bye, pairs, rematches = best
+    return ([(p1[0], p1[1], p2[0], p2[1]) for (p1, p2) in pairs] +
+            [(bye[0], bye[1], None, None)])
+
+
+def swissPairings(tournament_id=None):
     """Returns a list of pairs of players for the next round of a match.
 
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    Each player appears exactly once in the pairings.  Each player is paired
+    with another player with an equal or nearly-equal win record, that is, a
+    player adjacent to him or her in the standings, unless the two have
+    already played each other.  With an odd number of players the lowest
+    ranked player who has not had a bye gets one, returned as (id, name,
+    None, None); reportMatch(id, None) records it.
+
+    Args:
+      tournament_id: only pair the players of this tournament
 
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
@@ -212,43 +894,180 @@ def swissPairings():
         id2: the second player's unique id
         name2: the second player's name
     """
-    pairings = []
-    db = connect()
-    c = db.cursor()
-    query = """select players.id, players.name, count(matches.id) as wins
-               from players
-               left outer join matches on players.id = matches.winner
-               group by players.id
-               order by wins desc;
-    """
-    # I can use sql to pair players!!!
-    c.execute(query)
-    players = c.fetchall()
-    while len(players) > 0:
-        player1 = players.pop(0)
-        player2 = players.pop(0)
-        pair = (player1[0], player1[1], player2[0], player2[1])
-        pairings.append(pair)
-    return pairings
+    with transaction() as c:
+        _execute(c, 'pairing_standings', tournament_id)
+        rows = c.fetchall()
+    players, played, had_bye = _pairingArguments(rows)
+    return pairPlayers(players, played, had_bye)
 
 def swissPairingsForTournament(tournament_id):
-    """Works as swissPairings() but for a defined tournament"""
-    pairings = []
-    db = connect()
-    c = db.cursor()
-    query = """select players.id, players.name, count(matches.id) as wins
-               from players
-               left outer join matches on players.id = matches.winner
-               where players.tournament_id = %s
-               group by players.id
-               order by wins desc;
-    """
-    # I can use sql to pair players!!!
-    c.execute(query, (tournament_id,))
-    players = c.fetchall()
-    while len(players) > 0:
-        player1 = players.pop(0)
-        player2 = players.pop(0)
-        pair = (player1[0], player1[1], player2[0], player2[1])
-        pairings.append(pair)
+    """Works as swissPairings() but for a defined tournament
+
+    Served from memory when the memory engine is enabled.
+    """
+    if _engine is not None:
+        return _engine.pairings(tournament_id)
+    return swissPairings(tournament_id)
+
+def swissPairingsAll():
+    """Returns the next round's pairings of every tournament.
+
+    The standings and match history of all tournaments are read with a
+    single query, so opening a round costs one round trip however many
+    tournaments are running.
+
+    Returns:
+      A dict mapping each tournament_id to its swissPairingsForTournament()
+    """
+    with transaction() as c:
+        _execute(c, 'tournament_pairing_standings')
+        rows = c.fetchall()
+    pairings = {}
+    for tournament_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        players, played, had_bye = _pairingArguments(list(group))
+        pairings[tournament_id] = pairPlayers(players, played, had_bye)
     return pairings
+
+
+class _PlayerRecord(object):
+    """A player's wins, opponents and byes, as held by the memory engine"""
+
+    __slots__ = ('id', 'name', 'wins', 'opponents', 'byes')
+
+    def __init__(self, player_id, name, wins, opponents, byes):
+        self.id = player_id
+        self.name = name
+        self.wins = wins
+        self.opponents = array.array('l', opponents)
+        self.byes = byes
+
+
+class _TournamentState(object):
+    """One tournament's players and match history at a given version"""
+
+    __slots__ = ('version', 'checked', 'players', 'played')
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.checked = time.time()
+        self.players = dict(
+            (player_id, _PlayerRecord(player_id, name, wins, opponents, byes))
+            for (tournament_id, player_id, name, wins, opponents, byes) in rows)
+        self.played = _pairingArguments(rows)[1]
+
+    def standings(self):
+        records = sorted(self.players.itervalues(), key=lambda r: (-r.wins, r.id))
+        return [(r.id, r.name, r.wins, len(r.opponents) + r.byes) for r in records]
+
+    def hadBye(self):
+        return set(r.id for r in self.players.itervalues() if r.byes)
+
+    def record(self, winner, loser):
+        self.players[winner].wins += 1
+        if loser is None:
+            self.players[winner].byes += 1
+            return
+        self.players[winner].opponents.append(loser)
+        self.players[loser].opponents.append(winner)
+        self.played.add(_pairKey(winner, loser))
+
+
+class _MemoryEngine(object):
+    """Keeps the tournaments it is asked about in memory.
+
+    A tournament is loaded with one query the first time it is read.  Matches
+    reported through reportMatch() are applied to the copy in memory; any
+    other change bumps tournaments.version in the database, and a copy whose
+    version no longer matches is loaded again.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.tournaments = {}
+        self.lock = threading.Lock()
+
+    def state(self, tournament_id):
+        """Returns a current copy of the tournament, or None if it is gone"""
+        with self.lock:
+            state = self.tournaments.get(tournament_id)
+        now = time.time()
+        if state is not None and now - state.checked < self.check_interval:
+            return state
+        with transaction() as c:
+            # The version and the rows must come from the same snapshot, or a
+            # match committed in between would be applied twice.
+            c.execute("set transaction isolation level repeatable read")
+            c.execute("select version from tournaments where id = %s", (tournament_id,))
+            row = c.fetchone()
+            if row is None:
+                self.forget(tournament_id)
+                return None
+            if state is not None and state.version == row[0]:
+                state.checked = now
+                return state
+            _execute(c, 'pairing_standings', tournament_id)
+            state = _TournamentState(row[0], c.fetchall())
+        with self.lock:
+            self.tournaments[tournament_id] = state
+        return state
+
+    def standings(self, tournament_id):
+        state = self.state(tournament_id)
+        if state is None:
+            return []
+        with self.lock:
+            return state.standings()
+
+    def pairings(self, tournament_id):
+        state = self.state(tournament_id)
+        if state is None:
+            return []
+        with self.lock:
+            players = [(player_id, name, wins)
+                       for (player_id, name, wins, matches) in state.standings()]
+            return pairPlayers(players, state.played, state.hadBye())
+
+    def recordMatch(self, tournament_id, winner, loser, version):
+        """Applies a match written while the tournament was at version"""
+        with self.lock:
+            state = self.tournaments.get(tournament_id)
+            if state is None:
+                return
+            if (state.version != version or winner not in state.players
+                    or (loser is not None and loser not in state.players)):
+                del self.tournaments[tournament_id]
+                return
+            state.record(winner, loser)
+            state.version = version + 1
+
+    def forget(self, tournament_id=None):
+        """Drops one tournament, or every tournament, from memory"""
+        with self.lock:
+            if tournament_id is None:
+                self.tournaments.clear()
+            else:
+                self.tournaments.pop(tournament_id, None)
+
+
+def _forgetTournaments():
+    """Makes the memory engine reload tournaments after a bulk change"""
+    if _engine is not None:
+        _engine.forget()
+
+
+def enableMemoryEngine(check_interval=MEMORY_ENGINE_CHECK_INTERVAL):
+    """Serves playerStandingsForTournament() and swissPairingsForTournament()
+    from memory.
+
+    Each tournament is read from the database once and kept up to date by
+    reportMatch().  Changes made by other processes are noticed through
+    tournaments.version, at most check_interval seconds later.
+    """
+    global _engine
+    _engine = _MemoryEngine(check_interval)
+
+
+def disableMemoryEngine():
+    """Reads standings and pairings from the database again."""
+    global _engine
+    _engine = None
@@ -9,7 +9,9 @@
 
 CREATE TABLE tournaments (
     id          SERIAL PRIMARY KEY,
-    created     timestamp default now()
+    created     timestamp default now(),
+    num_players integer NOT NULL DEFAULT 0,
+    version     integer NOT NULL DEFAULT 0
   );
 
 CREATE TABLE players (
@@ -18,9 +20,203 @@ CREATE TABLE players (
     tournament_id integer REFERENCES tournaments
 );
 
+CREATE INDEX players_tournament_idx ON players (tournament_id);
+
+-- Keeps tournaments.num_players equal to the number of players registered
+-- in the tournament, so the capacity check on registration is O(1).  Also
+-- bumps the tournament's version, which changes whenever its players or
+-- matches do.
+CREATE FUNCTION count_tournament_players() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players - 1, version = version + 1
+        WHERE id = OLD.tournament_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE tournaments SET num_players = num_players + 1, version = version + 1
+        WHERE id = NEW.tournament_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_count_tournament_players
+    AFTER INSERT OR DELETE OR UPDATE OF tournament_id ON players
+    FOR EACH ROW EXECUTE PROCEDURE count_tournament_players();
+
 CREATE TABLE matches (
     id SERIAL PRIMARY KEY,
     tournament_id integer REFERENCES tournaments(id),
     winner integer REFERENCES players(id),
     loser integer REFERENCES players(id)
 );
+
+-- Per-tournament match history and per-player lookups.  The composite
+-- index lets per-tournament scans of matches be index-only.
+CREATE INDEX matches_tournament_idx ON matches (tournament_id, winner, loser);
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
+
+-- Win and match counts per player, maintained by triggers on players and
+-- matches so standings are read instead of aggregated from matches.
+CREATE TABLE standings (
+    player_id integer PRIMARY KEY REFERENCES players(id) ON DELETE CASCADE,
+    tournament_id integer,
+    wins integer NOT NULL DEFAULT 0,
+    matches integer NOT NULL DEFAULT 0
+);
+
+CREATE INDEX standings_tournament_idx ON standings (tournament_id, wins DESC, player_id);
+
+CREATE FUNCTION init_player_standings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO standings (player_id, tournament_id)
+        VALUES (NEW.id, NEW.tournament_id);
+    ELSE
+        UPDATE standings SET tournament_id = NEW.tournament_id
+        WHERE player_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_init_standings
+    AFTER INSERT OR UPDATE OF tournament_id ON players
+    FOR EACH ROW EXECUTE PROCEDURE init_player_standings();
+
+-- Both players of a match are updated by one statement, which locks their
+-- rows in index order so concurrent reports cannot deadlock.
+CREATE FUNCTION record_match_standings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE standings
+        SET wins = wins - (player_id = OLD.winner)::integer, matches = matches - 1
+        WHERE player_id IN (OLD.winner, OLD.loser);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE standings
+        SET wins = wins + (player_id = NEW.winner)::integer, matches = matches + 1
+        WHERE player_id IN (NEW.winner, NEW.loser);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_record_standings
+    AFTER INSERT OR DELETE OR UPDATE OF winner, loser ON matches
+    FOR EACH ROW EXECUTE PROCEDURE record_match_standings();
+
+-- Bumps the version of the tournament of a changed match, so copies of a
+-- tournament held in memory can tell that they are out of date.
+CREATE FUNCTION bump_tournament_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE tournaments SET version = version + 1 WHERE id = OLD.tournament_id;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        UPDATE tournaments SET version = version + 1 WHERE id = NEW.tournament_id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.tournament_id IS DISTINCT FROM OLD.tournament_id THEN
+            UPDATE tournaments SET version = version + 1 WHERE id = NEW.tournament_id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_bump_tournament_version
+    AFTER INSERT OR DELETE OR UPDATE ON matches
+    FOR EACH ROW EXECUTE PROCEDURE bump_tournament_version();
+
+-- Matches are partitioned by tournament: the matches table stays empty and
+-- each block of match_partition_size() tournaments has its matches in a
+-- child table, matches_<block>, created with the block's first tournament.
+-- Queries on matches read every partition; with tournament_id = constant,
+-- constraint exclusion reads only one.  A finished block is archived by
+-- detaching its partition (see tournament.archiveMatches).
+CREATE FUNCTION match_partition_size() RETURNS integer AS $$
+    SELECT 1000
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION match_partition(integer) RETURNS text AS $$
+    SELECT 'matches_' || ($1 / match_partition_size())
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Creates the partition holding the matches of a tournament, with the
+-- constraints, indexes and triggers of matches, unless it exists already.
+CREATE FUNCTION create_match_partition(tournament integer) RETURNS text AS $$
+DECLARE
+    partition text := match_partition(tournament);
+    low integer := tournament / match_partition_size() * match_partition_size();
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class
+               WHERE relname = partition AND pg_table_is_visible(oid)) THEN
+        RETURN partition;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (
+                        PRIMARY KEY (id),
+                        CHECK (tournament_id >= %s AND tournament_id < %s),
+                        FOREIGN KEY (tournament_id) REFERENCES tournaments(id),
+                        FOREIGN KEY (winner) REFERENCES players(id),
+                        FOREIGN KEY (loser) REFERENCES players(id)
+                    ) INHERITS (matches)',
+                   partition, low, low + match_partition_size());
+    EXECUTE format('CREATE INDEX ON %I (tournament_id, winner, loser)', partition);
+    EXECUTE format('CREATE INDEX ON %I (winner)', partition);
+    EXECUTE format('CREATE INDEX ON %I (loser)', partition);
+    EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR DELETE OR UPDATE OF winner, loser
+                    ON %I FOR EACH ROW EXECUTE PROCEDURE record_match_standings()',
+                   partition || '_record_standings', partition);
+    EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR DELETE OR UPDATE
+                    ON %I FOR EACH ROW EXECUTE PROCEDURE bump_tournament_version()',
+                   partition || '_bump_tournament_version', partition);
+    RETURN partition;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION create_tournament_match_partition() RETURNS trigger AS $$
+BEGIN
+    PERFORM create_match_partition(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournaments_create_match_partition
+    AFTER INSERT ON tournaments
+    FOR EACH ROW EXECUTE PROCEDURE create_tournament_match_partition();
+
+-- Sends each match inserted into matches to its tournament's partition.
+CREATE FUNCTION route_match() RETURNS trigger AS $$
+BEGIN
+    IF NEW.tournament_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT ($1).*', match_partition(NEW.tournament_id))
+    USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_route
+    BEFORE INSERT ON matches
+    FOR EACH ROW EXECUTE PROCEDURE route_match();
+
+-- Records a match, taking the tournament from the winner.  A routed insert
+-- returns no rows, so this returns the tournament and its version from
+-- before the match; no row if the winner is unknown.
+CREATE FUNCTION report_match(match_winner integer, match_loser integer)
+RETURNS TABLE (match_tournament integer, tournament_version integer) AS $$
+BEGIN
+    SELECT players.tournament_id, tournaments.version
+    INTO match_tournament, tournament_version
+    FROM players JOIN tournaments ON tournaments.id = players.tournament_id
+    WHERE players.id = match_winner;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+    INSERT INTO matches (tournament_id, winner, loser)
+    VALUES (match_tournament, match_winner, match_loser);
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio interface to the Swiss-system tournament
+#
+# Mirrors registerPlayer, reportMatch, playerStandings and swissPairings from
+# tournament.py on an asyncpg connection pool, so many coroutines can share a
+# handful of connections.  Needs Python 3 and asyncpg; the SQL and the
+# pairing engine are the ones in tournament.py.
+#
+
+import asyncio
+
+import asyncpg
+
+import tournament
+
+DATABASE = "tournament"
+
+# Bounds of the asyncpg pool.  Coroutines beyond the maximum wait for a
+# connection to be released.
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 8
+
+# tournament.REGISTER_PLAYER_QUERY with asyncpg's numbered parameters
+REGISTER_PLAYER_QUERY = tournament.REGISTER_PLAYER_QUERY % {
+    'name': '$1::text', 'capacity': '$2::integer'}
+
+REPORT_MATCH_QUERY = "select match_tournament from report_match($1, $2)"
+
+_pool = None
+_pool_lock = None
+
+
+async def getPool():
+    """Returns the module-level asyncpg pool, creating it on first use."""
+    global _pool, _pool_lock
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                database=DATABASE,
+                min_size=POOL_MIN_CONNECTIONS, max_size=POOL_MAX_CONNECTIONS)
+        return _pool
+
+
+async def closePool():
+    """Closes every pooled connection.  The pool is recreated on next use."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def _statement(name, tournament_id):
+    """Returns the SQL and arguments of one of tournament.STATEMENTS"""
+    query = tournament._statementQuery(name, tournament_id)[1]
+    if tournament_id is None:
+        return query, ()
+    return query, (tournament_id,)
+
+
+async def registerPlayer(name):
+    """Adds a player to the tournament database.
+
+    Works like tournament.registerPlayer().
+
+    Args:
+      name: the player's full name (need not be unique).
+    """
+    pool = await getPool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            await db.execute("select pg_advisory_xact_lock($1)",
+                             tournament.REGISTRATION_LOCK)
+            await db.execute(REGISTER_PLAYER_QUERY, name,
+                             tournament.TOURNAMENT_CAPACITY)
+
+
+async def reportMatch(winner, loser):
+    """Records the outcome of a single match between two players.
+
+    Works like tournament.reportMatch().
+
+    Args:
+      winner:  the id number of the player who won
+      loser:  the id number of the player who lost
+    """
+    pool = await getPool()
+    async with pool.acquire() as db:
+        tournament_id = await db.fetchval(REPORT_MATCH_QUERY, winner, loser)
+    if tournament_id is None:
+        raise ValueError("Unknown player id {id}".format(id=winner))
+
+
+async def playerStandings(tournament_id=None):
+    """Returns the players and their win records, sorted by wins.
+
+    Works like tournament.playerStandings(): a list of (id, name, wins,
+    matches) tuples.
+
+    Args:
+      tournament_id: only include the players of this tournament
+    """
+    query, args = _statement('standings', tournament_id)
+    pool = await getPool()
+    async with pool.acquire() as db:
+        rows = await db.fetch(query, *args)
+    return [tuple(row) for row in rows]
+
+
+async def swissPairings(tournament_id=None):
+    """Returns a list of pairs of players for the next round of a match.
+
+    Works like tournament.swissPairings(): a list of (id1, name1, id2,
+    name2) tuples, with a bye as (id, name, None, None).
+
+    Args:
+      tournament_id: only pair the players of this tournament
+    """
+    query, args = _statement('pairing_standings', tournament_id)
+    pool = await getPool()
+    async with pool.acquire() as db:
+        rows = await db.fetch(query, *args)
+    players, played, had_bye = tournament._pairingArguments([tuple(row) for row in rows])
+    return tournament.pairPlayers(players, played, had_bye)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Load test for tournament_async.py
+# Run against a scratch "tournament" database; the load test deletes data.
+#
+#   python3 tournament_async_bench.py [concurrent_reports]
+#
+
+import asyncio
+import os
+import sys
+import time
+
+# dbstats.py, which tournament.py uses, is shared with the forum one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import tournament
+import tournament_async
+
+
+def percentile(latencies, fraction):
+    """Returns the latency below which `fraction` of latencies fall."""
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def timedReport(winner, loser, latencies):
+    """Reports one match and records how long it took."""
+    start = time.time()
+    await tournament_async.reportMatch(winner, loser)
+    latencies.append(time.time() - start)
+
+
+async def loadReportMatch(reports):
+    """Drives `reports` concurrent reportMatch coroutines through the pool."""
+    ids = tournament.registerPlayers(["Player %d" % i for i in range(reports * 2)])
+    latencies = []
+    start = time.time()
+    await asyncio.gather(*[timedReport(winner, loser, latencies)
+                           for (winner, loser) in zip(ids[0::2], ids[1::2])])
+    elapsed = time.time() - start
+    standings = await tournament_async.playerStandings()
+    if sum(matches for (i, n, w, matches) in standings) != reports * 2:
+        raise ValueError("Every concurrent report should be recorded")
+    print("reportMatch: %d concurrent coroutines on %d connections"
+          % (reports, tournament_async.POOL_MAX_CONNECTIONS))
+    print("  throughput: %10.1f reports/s" % (reports / elapsed))
+    print("  p50:        %10.2f ms" % (percentile(latencies, 0.50) * 1000))
+    print("  p99:        %10.2f ms" % (percentile(latencies, 0.99) * 1000))
+    await tournament_async.closePool()
+
+
+def reset():
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+if __name__ == '__main__':
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    reset()
+    try:
+        asyncio.run(loadReportMatch(reports))
+    finally:
+        reset()
+        tournament.closePool()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#
+# Benchmarks for tournament.py
+# Run against a scratch "tournament" database; the benchmarks delete data.
+#
+#   python tournament_bench.py [name ...]
+#
+
+import os
+import random
+import sys
+import time
+
+import psycopg2
+
+# dbstats.py, which tournament.py uses, is shared with the forum one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dbstats
+import tournament
+
+
+def timeCalls(fn, calls):
+    """Calls fn() `calls` times and returns the achieved calls per second."""
+    start = time.time()
+    for _ in xrange(calls):
+        fn()
+    elapsed = time.time() - start
+    return calls / elapsed if elapsed else float('inf')
+
+
+def unpooledCountPlayers():
+    """countPlayers() as it was before pooling: one new connection per call."""
+    db = psycopg2.connect(tournament.DSN)
+    c = db.cursor()
+    c.execute("select count(*)as num from players")
+    num_players = c.fetchone()[0]
+    db.close()
+    return num_players
+
+
+def benchConnections(calls=2000):
+    """Compares countPlayers() with and without the connection pool."""
+    before = timeCalls(unpooledCountPlayers, calls)
+    after = timeCalls(tournament.countPlayers, calls)
+    print "connections: %d calls" % calls
+    print "  new connection per call: %10.1f calls/s" % before
+    print "  pooled connections:      %10.1f calls/s" % after
+    print "  speedup:                 %10.1fx" % (after / before)
+
+
+def benchBulk(players=4096):
+    """Compares one-by-one registration and reporting with the bulk APIs."""
+    names = ["Player %d" % i for i in xrange(players)]
+
+    def reset():
+        tournament.deleteMatches()
+        tournament.deletePlayers()
+        tournament.deleteTournaments()
+
+    print "bulk: %d players, %d matches" % (players, players // 2)
+    reset()
+    start = time.time()
+    for name in names:
+        tournament.registerPlayer(name)
+    single = time.time() - start
+    start = time.time()
+    tournament.registerPlayers(names)
+    bulk = time.time() - start
+    print "  registerPlayer:  %10.1f players/s" % (players / single)
+    print "  registerPlayers: %10.1f players/s" % (players / bulk)
+
+    reset()
+    ids = tournament.registerPlayers(names)
+    results = zip(ids[0::2], ids[1::2])
+    start = time.time()
+    for winner, loser in results:
+        tournament.reportMatch(winner, loser)
+    single = time.time() - start
+    start = time.time()
+    tournament.reportMatches(results)
+    bulk = time.time() - start
+    print "  reportMatch:     %10.1f matches/s" % (len(results) / single)
+    print "  reportMatches:   %10.1f matches/s" % (len(results) / bulk)
+    reset()
+
+
+def popPairings(players):
+    """The pairing loop swissPairings() used before the pairing engine."""
+    players = list(players)
+    pairings = []
+    while len(players) > 0:
+        player1 = players.pop(0)
+        player2 = players.pop(0)
+        pairings.append((player1[0], player1[1], player2[0], player2[1]))
+    return pairings
+
+
+def simulateStandings(num_players, rounds):
+    """Plays random Swiss rounds in memory.
+
+    Returns the standings as (id, name, wins) tuples sorted like
+    swissPairings() reads them, and the set of pairs that have met.
+    """
+    wins = [0] * num_players
+    played = set()
+    for _ in xrange(rounds):
+        players = sorted(((i, "Player %d" % i, wins[i]) for i in xrange(num_players)),
+                         key=lambda p: (-p[2], p[0]))
+        for (id1, name1, id2, name2) in tournament.pairPlayers(players, played):
+            if id2 is not None:
+                wins[random.choice((id1, id2))] += 1
+                played.add(tournament._pairKey(id1, id2))
+    players = sorted(((i, "Player %d" % i, wins[i]) for i in xrange(num_players)),
+                     key=lambda p: (-p[2], p[0]))
+    return players, played
+
+
+def benchPairings(num_players=10000, rounds=10, repeat=20):
+    """Times the pairing engine against the old list.pop(0) loop."""
+    players, played = simulateStandings(num_players, rounds)
+    start = time.time()
+    for _ in xrange(repeat):
+        popPairings(players)
+    before = (time.time() - start) / repeat
+    start = time.time()
+    for _ in xrange(repeat):
+        pairings = tournament.pairPlayers(players, played)
+    after = (time.time() - start) / repeat
+    rematches = sum(1 for (id1, name1, id2, name2) in pairings
+                    if id2 is not None and tournament._pairKey(id1, id2) in played)
+    print "pairings: %d players after %d rounds" % (num_players, rounds)
+    print "  list.pop(0) loop: %10.2f ms/round" % (before * 1000)
+    print "  pairing engine:   %10.2f ms/round (%d rematches)" % (after * 1000, rematches)
+
+
+def benchPrepared(calls=2000):
+    """Compares prepared per-tournament standings with re-planning each call."""
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+    ids = tournament.registerPlayers(["Player %d" % i for i in xrange(800)])
+    tournament.reportMatches(zip(ids[0::2], ids[1::2]))
+    tournament_id = tournament.retrieveLastPlayerTournamentId()
+    query = tournament.STATEMENTS['standings'][1] % {
+        'filter': 'standings.tournament_id = %s'}
+
+    def unprepared():
+        with tournament.transaction() as c:
+            c.execute(query, (tournament_id,))
+            return c.fetchall()
+
+    tournament.resetStatementStats()
+    before = timeCalls(unprepared, calls)
+    after = timeCalls(lambda: tournament.playerStandings(tournament_id), calls)
+    print "prepared: %d calls of playerStandingsForTournament" % calls
+    print "  parsed and planned per call: %10.1f calls/s" % before
+    print "  prepared statement:          %10.1f calls/s" % after
+    for name, (prepare, executions, execute) in sorted(tournament.statementStats().items()):
+        print "  %-30s prepare %7.3f ms, %6d executions, %7.3f ms avg" % (
+            name, prepare * 1000, executions, execute * 1000 / max(executions, 1))
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+def benchPairingsAll(pods=500, repeat=10):
+    """Compares per-tournament pairing calls with swissPairingsAll()."""
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+    ids = tournament.registerPlayers(
+        ["Player %d" % i for i in xrange(pods * tournament.TOURNAMENT_CAPACITY)])
+    tournament.reportMatches(zip(ids[0::2], ids[1::2]))
+
+    def eachTournament():
+        return dict((tournament_id, tournament.swissPairingsForTournament(tournament_id))
+                    for (tournament_id,) in tournament.retrieveAllTournamentId())
+
+    before = timeCalls(eachTournament, repeat)
+    after = timeCalls(tournament.swissPairingsAll, repeat)
+    print "pairings_all: %d tournaments" % pods
+    print "  swissPairingsForTournament each: %8.2f rounds opened/s" % before
+    print "  swissPairingsAll:                %8.2f rounds opened/s" % after
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+def benchMemory(calls=2000):
+    """Compares standings and pairings read from the database with the
+    memory engine, while matches are being reported."""
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+    ids = tournament.registerPlayers(
+        ["Player %d" % i for i in xrange(tournament.TOURNAMENT_CAPACITY)])
+    tournament_id = tournament.retrieveLastPlayerTournamentId()
+    results = zip(ids[0::2], ids[1::2])
+
+    def liveEvent():
+        for (winner, loser) in results:
+            tournament.reportMatch(winner, loser)
+            tournament.playerStandingsForTournament(tournament_id)
+        tournament.swissPairingsForTournament(tournament_id)
+
+    before = timeCalls(lambda: tournament.playerStandingsForTournament(tournament_id), calls)
+    rounds_before = timeCalls(liveEvent, calls // 10)
+    tournament.enableMemoryEngine()
+    try:
+        after = timeCalls(lambda: tournament.playerStandingsForTournament(tournament_id), calls)
+        rounds_after = timeCalls(liveEvent, calls // 10)
+    finally:
+        tournament.disableMemoryEngine()
+    print "memory: %d players in one tournament" % tournament.TOURNAMENT_CAPACITY
+    print "  standings from the database: %10.1f calls/s" % before
+    print "  standings from memory:       %10.1f calls/s" % after
+    print "  rounds, database only:       %10.1f rounds/s" % rounds_before
+    print "  rounds, memory engine:       %10.1f rounds/s" % rounds_after
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+def benchTiebreaks(players=50000, rounds=4):
+    """Times standings with NumPy tiebreakers against plain standings."""
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+    ids = tournament.registerPlayers(["Player %d" % i for i in xrange(players)])
+    for _ in xrange(rounds):
+        tournament.reportMatches(zip(ids[0::2], ids[1::2]))
+    start = time.time()
+    tournament.playerStandings()
+    plain = time.time() - start
+    start = time.time()
+    tournament.playerStandingsWithTiebreaks()
+    tiebreaks = time.time() - start
+    print "tiebreaks: %d players, %d matches" % (players, rounds * players // 2)
+    print "  playerStandings:              %8.3f s" % plain
+    print "  playerStandingsWithTiebreaks: %8.3f s" % tiebreaks
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+BENCHMARKS = {'bulk': benchBulk,
+              'connections': benchConnections,
+              'memory': benchMemory,
+              'pairings': benchPairings,
+              'pairings_all': benchPairingsAll,
+              'prepared': benchPrepared,
+              'tiebreaks': benchTiebreaks,
+              }
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    dbstats.enableStats()
+    for name in names:
+        BENCHMARKS[name]()
+    dbstats.dumpStats()
+    tournament.closePool()
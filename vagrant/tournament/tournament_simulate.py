@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Simulates complete Swiss events against tournament.py and reports the
+# throughput, latency percentiles and query counts of each function.
+# Run against a scratch "tournament" database; the simulation deletes data.
+#
+#   python tournament_simulate.py [--players N] [--rounds N] [--seed N]
+#                                 [--json results.json] [--slow-query-ms MS]
+#
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+# dbstats.py, which tournament.py uses, is shared with the forum one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dbstats
+import tournament
+
+# The functions whose calls are timed, in the order they are reported
+FUNCTIONS = ['registerPlayer', 'swissPairings', 'reportMatch', 'playerStandings']
+
+
+class Recorder(object):
+    """Times calls of the FUNCTIONS"""
+
+    def __init__(self):
+        self.latencies = dict((name, []) for name in FUNCTIONS)
+        # dbstats name of the function actually called for each of FUNCTIONS
+        self.functions = {}
+        dbstats.resetStats()
+
+    def call(self, name, fn, *args):
+        """Calls fn(*args), recording it as a call of the named function"""
+        self.functions[name] = '%s.%s' % (fn.__module__, fn.__name__)
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.latencies[name].append(time.time() - start)
+
+    def results(self):
+        """Per function: calls, calls/s, latency percentiles and dbstats counts"""
+        results = {}
+        counted = dbstats.stats()
+        for name in FUNCTIONS:
+            latencies = sorted(self.latencies[name])
+            if not latencies:
+                continue
+            calls = len(latencies)
+            total = sum(latencies)
+            counts = counted.get(self.functions[name], {})
+            results[name] = {
+                'calls': calls,
+                'seconds': total,
+                'calls_per_second': calls / total if total else None,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p90_ms': percentile(latencies, 0.90) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+                'cursors': counts.get('cursors', 0),
+                'queries': counts.get('statements', 0),
+                'queries_per_call': float(counts.get('statements', 0)) / calls,
+                'query_ms': counts.get('seconds', 0.0) * 1000,
+                'rows': counts.get('rows', 0),
+            }
+        return results
+
+
+def percentile(ordered, fraction):
+    """Returns the value below which `fraction` of the sorted values fall."""
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def reset():
+    tournament.deleteMatches()
+    tournament.deletePlayers()
+    tournament.deleteTournaments()
+
+
+def simulate(players, rounds, recorder):
+    """Registers `players` players and plays every tournament to the end.
+
+    Each round pairs every tournament with swissPairingsForTournament(),
+    reports each match with a random winner and reads the new standings.
+    A bye is not reported.
+    """
+    for i in xrange(players):
+        recorder.call('registerPlayer', tournament.registerPlayer, "Player %d" % i)
+    tournaments = [tournament_id for (tournament_id,) in tournament.retrieveAllTournamentId()]
+    for _ in xrange(rounds):
+        for tournament_id in tournaments:
+            pairings = recorder.call('swissPairings',
+                                     tournament.swissPairingsForTournament, tournament_id)
+            for (id1, name1, id2, name2) in pairings:
+                if id2 is None:
+                    continue
+                winner, loser = (id1, id2) if random.random() < 0.5 else (id2, id1)
+                recorder.call('reportMatch', tournament.reportMatch, winner, loser)
+            recorder.call('playerStandings',
+                          tournament.playerStandingsForTournament, tournament_id)
+    return len(tournaments)
+
+
+def report(summary):
+    print "simulation: %(players)d players in %(tournaments)d tournaments, %(rounds)d rounds" % summary
+    print "  %-16s %9s %11s %9s %9s %9s %9s %8s" % (
+        'function', 'calls', 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries')
+    for name in FUNCTIONS:
+        if name not in summary['functions']:
+            continue
+        stats = summary['functions'][name]
+        print "  %-16s %9d %11.1f %9.2f %9.2f %9.2f %9.2f %8.1f" % (
+            name, stats['calls'], stats['calls_per_second'] or 0, stats['p50_ms'],
+            stats['p90_ms'], stats['p99_ms'], stats['max_ms'], stats['queries_per_call'])
+    print "  total: %.1f s" % summary['seconds']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate Swiss events with tournament.py.')
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=tournament.SWISS_ROUNDS,
+                        help='rounds per tournament (default: enough to find a winner)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--slow-query-ms', type=float,
+                        help='log statements slower than this with their plan')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    reset()
+    dbstats.enableStats()
+    if args.slow_query_ms is not None:
+        dbstats.SLOW_QUERY_SECONDS = args.slow_query_ms / 1000.0
+    recorder = Recorder()
+    started = datetime.datetime.utcnow()
+    start = time.time()
+    num_tournaments = simulate(args.players, args.rounds, recorder)
+    summary = {
+        'started': started.isoformat() + 'Z',
+        'seconds': time.time() - start,
+        'players': args.players,
+        'tournaments': num_tournaments,
+        'rounds': args.rounds,
+        'seed': args.seed,
+        'tournament_capacity': tournament.TOURNAMENT_CAPACITY,
+        'functions': recorder.results(),
+    }
+    report(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    reset()
+    tournament.closePool()
@@ -6,6 +6,15 @@
 # If you do add any of the extra credit options, be sure to add/modify these test cases
 # as appropriate to account for your module's added functionality.
 
+import os
+import re
+import sys
+import time
+
+# dbstats.py, which tournament.py uses, is shared with the forum one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import tournament
 from tournament import *
 
 def testCount():
@@ -350,6 +359,451 @@ def testMultipleTournamentsSwissPairings():
         raise ValueError("Pairings of different tournaments should be different")
     print "21. Pairs are different"
 
+def testPooledConnections():
+    """Test that repeated calls reuse pooled connections instead of leaking them"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    for i in range(POOL_MAX_CONNECTIONS * 4):
+        registerPlayer("Player %d" % i)
+        countPlayers()
+        playerStandings()
+    db = connect()
+    c = db.cursor()
+    c.execute("select count(*) from pg_stat_activity where datname = current_database()")
+    num_connections = c.fetchone()[0]
+    db.close()
+    # The extra connection is the one opened just above to run the check
+    if num_connections > POOL_MAX_CONNECTIONS + 1:
+        raise ValueError(
+            "Calls should reuse pooled connections. Got {n} open connections".format(n=num_connections))
+    # A pool resized after import makes the surplus threads wait
+    import threading
+    closePool()
+    tournament.POOL_MAX_CONNECTIONS = 2
+    errors = []
+    def standings():
+        try:
+            playerStandings()
+        except Exception as e:
+            errors.append(e)
+    try:
+        threads = [threading.Thread(target=standings) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise ValueError("Callers beyond the pool size should wait. Got {e!r}".format(e=errors[0]))
+        if getPool().maxconn != 2:
+            raise ValueError("The pool should be sized when it is created, not at import")
+    finally:
+        closePool()
+        tournament.POOL_MAX_CONNECTIONS = POOL_MAX_CONNECTIONS
+    print "22. Repeated calls reuse at most POOL_MAX_CONNECTIONS connections."
+
+def testConcurrentRegistration():
+    """Test that concurrent registrations never overfill a tournament"""
+    import threading
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    threads = [threading.Thread(target=registerPlayer, args=("Player %d" % i,))
+               for i in range(TOURNAMENT_CAPACITY * 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tournaments = retrieveAllTournamentId()
+    if len(tournaments) != 3:
+        raise ValueError(
+            "24 concurrent registrations should fill 3 tournaments. Got {n}".format(n=len(tournaments)))
+    for tournament_id in tournaments:
+        if countPlayersInTournament(tournament_id) != TOURNAMENT_CAPACITY:
+            raise ValueError("Each tournament should hold exactly 8 players")
+    print "23. Concurrent registrations fill each tournament exactly."
+
+def testBulkRegistrationAndReporting():
+    """Test registerPlayers() and reportMatches()"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    registerPlayer("Twilight Sparkle")
+    player_ids = registerPlayers(["Player %d" % i for i in range(19)])
+    if len(player_ids) != 19 or countPlayers() != 20:
+        raise ValueError("registerPlayers should register every player")
+    tournaments = retrieveAllTournamentId()
+    num_players = [countPlayersInTournament(t) for t in tournaments]
+    if num_players != [8, 8, 4]:
+        raise ValueError(
+            "Bulk registration should fill tournaments in order. Got {n}".format(n=num_players))
+    print "24. registerPlayers fills the open tournament before creating new ones."
+    first_tournament = tournaments[0][0]
+    [id1, id2, id3, id4, id5, id6, id7, id8] = [row[0] for row in playerStandingsForTournament(first_tournament)]
+    reportMatches([(id1, id2), (id3, id4), (id5, id6), (id7, id8)])
+    for (i, n, w, m) in playerStandingsForTournament(first_tournament):
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if i in (id1, id3, id5, id7) and w != 1:
+            raise ValueError("Each match winner should have one win recorded.")
+    try:
+        reportMatches([(id1, id3), (-1, id2)])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("reportMatches should reject an unknown winner")
+    for (i, n, w, m) in playerStandingsForTournament(first_tournament):
+        if m != 1:
+            raise ValueError("A rejected batch should record no matches.")
+    print "25. reportMatches records a batch of matches atomically."
+
+def testStandingsAfterSeveralRounds():
+    """Test that standings count every match once after several rounds"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    [id1, id2, id3, id4] = registerPlayers(["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
+    reportMatches([(id1, id2), (id3, id4), (id1, id3), (id2, id4)])
+    expected = [(id1, 2, 2), (id2, 1, 2), (id3, 1, 2), (id4, 0, 2)]
+    for standings in (playerStandings(), playerStandingsForTournament(retrieveLastPlayerTournamentId())):
+        if [(i, w, m) for (i, n, w, m) in standings] != expected:
+            raise ValueError(
+                "After two rounds standings should be {e}. Got {s}".format(e=expected, s=standings))
+    print "26. After two rounds, standings count each win and match once."
+
+def explain(query, params=None):
+    """Returns the text of the query plan PostgreSQL picks for query"""
+    with transaction() as c:
+        c.execute("explain " + query, params)
+        return "\n".join(row[0] for row in c.fetchall())
+
+def testIndexScans():
+    """Test that the hot lookups use index scans at 100k players"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in xrange(100000)])
+    reportMatches(zip(player_ids[0::2], player_ids[1::2]))
+    with transaction() as c:
+        c.execute("analyze")
+    tournament_id = retrieveLastPlayerTournamentId()
+    last_tournament_size = 100000 % TOURNAMENT_CAPACITY or TOURNAMENT_CAPACITY
+    if countPlayersInTournament(tournament_id) != last_tournament_size:
+        raise ValueError("The player counter should match the registered players")
+    # A tournament in a full partition of matches.  Other partitions, such as
+    # a partly filled first one, may be small enough to scan.
+    middle_tournament_id = player_tournament_id(player_ids[50000])
+    middle_partition = "matches_%d" % (middle_tournament_id // MATCH_PARTITION_SIZE)
+    lookups = [
+        ("select id from players where tournament_id = %s", (tournament_id,)),
+        ("select tournament_id from players where id = %s", (player_ids[0],)),
+        ("select id from matches where winner = %s", (player_ids[50000],)),
+        ("select id from matches where loser = %s", (player_ids[50001],)),
+        ("select loser from matches where tournament_id = %s and winner = %s",
+         (middle_tournament_id, player_ids[50000])),
+        ("select winner, loser from matches where tournament_id = %s", (middle_tournament_id,)),
+        ("select id, num_players from tournaments order by id desc limit 1", None),
+        ("select player_id from standings where tournament_id = %s order by wins desc, player_id", (tournament_id,)),
+    ]
+    for query, params in lookups:
+        plan = explain(query, params)
+        scanned = [table for table in re.findall(r"Seq Scan on (\w+)", plan)
+                   if table == middle_partition or not table.startswith("matches")]
+        if "Index" not in plan or scanned:
+            raise ValueError(
+                "Expected an index scan for {q}, got:\n{p}".format(q=query, p=plan))
+        if "from matches where tournament_id" in query and len(partitionsRead(plan)) != 1:
+            raise ValueError(
+                "Expected {q} to read one partition, got:\n{p}".format(q=query, p=plan))
+    # The pairing statement, prepared once per connection, must still read one
+    # partition once the server may have switched to a generic plan.
+    with transaction() as c:
+        c.execute("select match_partition_size(), current_setting('server_version_num')::int")
+        partition_size, server_version = c.fetchone()
+        if partition_size != MATCH_PARTITION_SIZE:
+            raise ValueError("MATCH_PARTITION_SIZE should equal match_partition_size()")
+        for _ in range(10):
+            tournament._execute(c, 'pairing_standings', middle_tournament_id)
+        statement = tournament._statementQuery('pairing_standings', middle_tournament_id)[0]
+        c.execute("explain execute " + statement + " (%s)", (middle_tournament_id,))
+        plan = "\n".join(row[0] for row in c.fetchall())
+        if len(partitionsRead(plan)) != 1 or "Seq Scan on matches_" in plan:
+            raise ValueError(
+                "Expected the prepared pairing statement to read one partition, got:\n{p}".format(p=plan))
+        if server_version >= 140000:
+            c.execute("select generic_plans from pg_prepared_statements where name = %s",
+                      (statement,))
+            if c.fetchone()[0] == 0:
+                raise ValueError("The prepared pairing statement should be planned once, not per call")
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    print "27. Hot lookups use index scans with 100k players registered."
+
+def partitionsRead(plan):
+    """The partitions of matches read by a plan"""
+    return set(re.findall(r" on (matches_\d+)", plan))
+
+def testStandingsTableConsistency():
+    """Test that the standings table matches the match history"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in range(16)])
+    reportMatches(zip(player_ids[0::2], player_ids[1::2]))
+    reportMatch(player_ids[0], player_ids[2])
+    reportMatch(player_ids[3], player_ids[1])
+    with transaction() as c:
+        c.execute("delete from matches where winner = %s", (player_ids[3],))
+        c.execute("""select standings.player_id from standings
+                     left outer join (
+                         select player, sum(won) as wins, count(*) as matches
+                         from (select winner as player, 1 as won from matches
+                               union all
+                               select loser as player, 0 as won from matches) as results
+                         group by player
+                     ) as records on records.player = standings.player_id
+                     where standings.wins != coalesce(records.wins, 0)
+                        or standings.matches != coalesce(records.matches, 0)""")
+        inconsistent = c.fetchall()
+    if inconsistent:
+        raise ValueError(
+            "Standings disagree with matches for players {p}".format(p=inconsistent))
+    deleteMatches()
+    for (i, n, w, m) in playerStandings():
+        if w != 0 or m != 0:
+            raise ValueError("After deleting matches, standings should be reset.")
+    print "28. The standings table stays consistent with reported and deleted matches."
+
+def testPairingsAvoidRematches():
+    """Test that pairings avoid rematches and give a bye to an odd player"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    [id1, id2, id3, id4] = registerPlayers(["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"])
+    reportMatches([(id1, id2), (id3, id4), (id1, id3), (id2, id4)])
+    pairings = swissPairings()
+    actual_pairs = set(frozenset([pid1, pid2]) for (pid1, pname1, pid2, pname2) in pairings)
+    if actual_pairs != set([frozenset([id1, id4]), frozenset([id2, id3])]):
+        raise ValueError(
+            "Players who already met should not be paired again. Got {p}".format(p=pairings))
+    print "29. Pairings avoid rematches."
+    id5 = registerPlayers(["Melpomene Murray"])[0]
+    pairings = swissPairings()
+    if len(pairings) != 3 or pairings[-1] != (id5, "Melpomene Murray", None, None):
+        raise ValueError(
+            "With five players the lowest ranked player should get a bye. Got {p}".format(p=pairings))
+    print "30. With an odd number of players the lowest ranked player gets a bye."
+
+def testPreparedStatements():
+    """Test that repeated calls reuse the prepared statements"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    registerPlayers(["Player %d" % i for i in range(8)])
+    tournament_id = retrieveLastPlayerTournamentId()
+    resetStatementStats()
+    for i in range(POOL_MAX_CONNECTIONS * 4):
+        playerStandingsForTournament(tournament_id)
+    stats = statementStats()
+    if 'standings_for_tournament' not in stats or 'standings' in stats:
+        raise ValueError("Per-tournament standings should use their own prepared statement")
+    prepare, executions, execute = stats['standings_for_tournament']
+    if executions != POOL_MAX_CONNECTIONS * 4:
+        raise ValueError("Every call should execute the prepared statement")
+    print "31. Global and per-tournament queries run through prepared statements."
+
+def testSwissPairingsAll():
+    """Test that swissPairingsAll() pairs every tournament like swissPairingsForTournament()"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in range(20)])
+    reportMatches(zip(player_ids[0::2], player_ids[1::2]))
+    all_pairings = swissPairingsAll()
+    tournaments = [row[0] for row in retrieveAllTournamentId()]
+    if sorted(all_pairings) != tournaments:
+        raise ValueError("swissPairingsAll should pair every tournament")
+    for tournament_id in tournaments:
+        if all_pairings[tournament_id] != swissPairingsForTournament(tournament_id):
+            raise ValueError(
+                "swissPairingsAll should match swissPairingsForTournament for {t}".format(t=tournament_id))
+    print "32. swissPairingsAll pairs every tournament in one query."
+
+def testMemoryEngine():
+    """Test that the memory engine agrees with the database, also after a
+    match is written behind its back"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in range(8)])
+    tournament_id = retrieveLastPlayerTournamentId()
+    enableMemoryEngine(check_interval=0)
+    try:
+        playerStandingsForTournament(tournament_id)
+        for (winner, loser) in zip(player_ids[0::2], player_ids[1::2]):
+            reportMatch(winner, loser)
+        if playerStandingsForTournament(tournament_id) != playerStandings(tournament_id):
+            raise ValueError("Memory engine standings should match the database after reportMatch")
+        if swissPairingsForTournament(tournament_id) != swissPairings(tournament_id):
+            raise ValueError("Memory engine pairings should match the database after reportMatch")
+        db = connect()
+        c = db.cursor()
+        c.execute("""insert into matches (tournament_id, winner, loser)
+                     values (%s, %s, %s)""", (tournament_id, player_ids[1], player_ids[3]))
+        db.commit()
+        db.close()
+        if playerStandingsForTournament(tournament_id) != playerStandings(tournament_id):
+            raise ValueError("Memory engine should reload a tournament changed by another connection")
+    finally:
+        disableMemoryEngine()
+    print "33. Memory engine serves standings and pairings and notices external writes."
+
+def testTiebreakStandings():
+    """Test Buchholz and opponents' match-win percentage on a known event"""
+    try:
+        import numpy
+    except ImportError:
+        print "34. Skipped playerStandingsWithTiebreaks: NumPy is not installed."
+        return
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    id1, id2, id3, id4 = registerPlayers(["Bruno Walton", "Boots O'Neal",
+                                          "Cathy Burton", "Diane Grant"])
+    reportMatches([(id1, id2), (id3, id4), (id1, id3), (id4, id2)])
+    standings = playerStandingsWithTiebreaks()
+    if [row[:4] for row in standings] != [
+            (id1, "Bruno Walton", 2, 2), (id3, "Cathy Burton", 1, 2),
+            (id4, "Diane Grant", 1, 2), (id2, "Boots O'Neal", 0, 2)]:
+        raise ValueError("Ties on wins should be broken by Buchholz: {s}".format(s=standings))
+    if [row[4] for row in standings] != [1, 3, 1, 3]:
+        raise ValueError("Buchholz should be the total wins of each player's opponents")
+    if abs(standings[0][5] - (1.0 / 3 + 0.5) / 2) > 1e-9:
+        raise ValueError("Opponents' match-win percentage should floor each opponent at 1/3")
+    print "34. playerStandingsWithTiebreaks breaks ties by Buchholz and opponents' match-win percentage."
+
+def testArchiveMatches():
+    """Test that a tournament's matches are read from one partition, and that
+    archiving detaches the partition once its tournaments are finished"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in range(16)])
+    tournaments = sorted(set(player_tournament_id(player_id) for player_id in player_ids))
+    reportMatches(swissPairingPairs(tournaments[0]))
+    tournament_id = tournaments[0]
+    plan = explain("select winner, loser from matches where tournament_id = %s", (tournament_id,))
+    if len(partitionsRead(plan)) != 1:
+        raise ValueError("A tournament's matches should be read from one partition:\n{p}".format(p=plan))
+    for _ in range(SWISS_ROUNDS - 1):
+        reportMatches(swissPairingPairs(tournaments[0]))
+    try:
+        archiveMatches(tournament_id)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A block with a running tournament should not be archived")
+    for _ in range(SWISS_ROUNDS):
+        reportMatches(swissPairingPairs(tournaments[1]))
+    standings = playerStandings()
+    archived = archiveMatches(tournament_id)
+    num_matches = len(tournaments) * SWISS_ROUNDS * TOURNAMENT_CAPACITY / 2
+    with transaction() as c:
+        c.execute("select count(*) from matches")
+        if c.fetchone()[0] != 0:
+            raise ValueError("After archiving, the matches should be gone from matches")
+        c.execute("select count(*) from " + archived + " where tournament_id in %s",
+                  (tuple(tournaments),))
+        if c.fetchone()[0] != num_matches:
+            raise ValueError("The archived table should keep every match")
+    if playerStandings() != standings:
+        raise ValueError("Archiving should keep the players' records")
+    if swissPairingsForTournament(tournament_id) == []:
+        raise ValueError("Pairings should still work after archiving")
+    reportMatch(player_ids[0], player_ids[1])
+    reportMatches([(player_ids[8], player_ids[9])])
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    # The archive outlives the players and tournaments it recorded
+    with transaction() as c:
+        c.execute("drop table " + archived)
+    print "35. A tournament's matches live in one partition, which archiveMatches detaches."
+
+def swissPairingPairs(tournament_id):
+    """The (winner, loser) pairs of the next round, first player winning"""
+    return [(id1, id2) for (id1, name1, id2, name2) in swissPairingsForTournament(tournament_id)]
+
+def testDroppedConnections():
+    """Test that a pooled connection the server dropped is replaced"""
+    countPlayers()
+    db = connect()
+    c = db.cursor()
+    c.execute("""select pg_terminate_backend(pid) from pg_stat_activity
+                 where datname = current_database() and pid <> pg_backend_pid()""")
+    db.close()
+    time.sleep(0.1)
+    if countPlayers() != 0:
+        raise ValueError("After the server drops pooled connections, countPlayers() should still work")
+    print "36. Pooled connections the server dropped are replaced on checkout."
+
+def testByes():
+    """Test that byes are recorded and go to a different player each round"""
+    deleteMatches()
+    deletePlayers()
+    deleteTournaments()
+    player_ids = registerPlayers(["Player %d" % i for i in range(5)])
+    tournament_id = player_tournament_id(player_ids[0])
+    byes = []
+    played = set()
+    enableMemoryEngine()
+    try:
+        for _ in range(4):
+            pairings = swissPairings(tournament_id)
+            if swissPairingsForTournament(tournament_id) != pairings:
+                raise ValueError("The memory engine should pair byes like the database")
+            for (id1, name1, id2, name2) in pairings:
+                if id2 is None:
+                    byes.append(id1)
+                    reportMatch(id1, None)
+                else:
+                    if frozenset([id1, id2]) in played:
+                        raise ValueError("Five players should meet no one twice in four rounds")
+                    played.add(frozenset([id1, id2]))
+                    reportMatch(id1, id2)
+    finally:
+        disableMemoryEngine()
+    if len(set(byes)) != 4:
+        raise ValueError("Each bye should go to a player without one. Got {b}".format(b=byes))
+    if sum(matches for (i, n, w, matches) in playerStandings()) != 2 * 4 * 2 + 4:
+        raise ValueError("A bye should count as a match of its player")
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        playerStandingsWithTiebreaks()
+    print "37. Byes are recorded with reportMatch(id, None) and go to a player without one."
+
+def testStatsSwitch():
+    """Test that dbstats counts statements only once enabled"""
+    import dbstats
+    dbstats.resetStats()
+    countPlayers()
+    if dbstats.stats():
+        raise ValueError("dbstats should count nothing until enableStats() is called")
+    dbstats.enableStats()
+    try:
+        countPlayers()
+    finally:
+        dbstats.disableStats()
+    counts = dbstats.stats().get('tournament.countPlayers')
+    if not counts or counts['statements'] < 1:
+        raise ValueError("Once enabled, dbstats should count the statements of countPlayers()")
+    dbstats.resetStats()
+    print "38. dbstats counts statements only once enabled."
+
 if __name__ == '__main__':
     """Required tests"""
     testCount()
@@ -362,4 +816,19 @@ if __name__ == '__main__':
     testMultipleTournamentsCountAndRegister()
     testMultipleTournamentsReportMatches()
     testMultipleTournamentsSwissPairings()
+    testPooledConnections()
+    testConcurrentRegistration()
+    testBulkRegistrationAndReporting()
+    testStandingsAfterSeveralRounds()
+    testIndexScans()
+    testStandingsTableConsistency()
+    testPairingsAvoidRematches()
+    testPreparedStatements()
+    testSwissPairingsAll()
+    testMemoryEngine()
+    testTiebreakStandings()
+    testArchiveMatches()
+    testDroppedConnections()
+    testByes()
+    testStatsSwitch()
     print "Success!  All tests pass!"